@@ -13,8 +13,9 @@ __copyright__ = '(c) 2012 Canonical Ltd.'
 __license__ = 'LGPL 3+'
 __version__ = '0.6'
 
-from dbusmock.mockobject import DBusMockObject, MOCK_IFACE, get_object, get_objects
+from dbusmock.mockobject import (DBusMockObject, MOCK_IFACE, OBJECT_MANAGER_IFACE, get_object,
+                                 get_objects, get_children)
 from dbusmock.testcase import DBusTestCase
 
-__all__ = ['DBusMockObject', 'MOCK_IFACE', 'DBusTestCase', 'get_object',
-           'get_objects']
+__all__ = ['DBusMockObject', 'MOCK_IFACE', 'OBJECT_MANAGER_IFACE', 'DBusTestCase', 'get_object',
+           'get_objects', 'get_children']
@@ -28,6 +28,32 @@ def parse_args():
                         help='path of log file')
     parser.add_argument('-t', '--template', metavar='NAME',
                         help='template to load (instead of specifying name, path, interface)')
+    parser.add_argument('-m', '--is-object-manager', action='store_true',
+                        help='provide the org.freedesktop.DBus.ObjectManager interface on the '
+                        'main object')
+    parser.add_argument('--method-called', choices=['signal', 'aggregate', 'off'], default='signal',
+                        help='emit a MethodCalled signal for every call, one MethodsCalled signal '
+                        'for all calls in one main loop iteration or --method-called-window, '
+                        'or neither (default: signal)')
+    parser.add_argument('--method-called-window', metavar='MS', type=int, default=0,
+                        help='time window for collecting calls into one MethodsCalled signal '
+                        '(default: 0, i. e. one main loop iteration)')
+    parser.add_argument('--log-level', choices=['off', 'calls', 'args', 'full'], default='args',
+                        help='what to log: nothing, only method/signal names, names and arguments '
+                        '(abbreviating big arrays), or complete arguments (default: args)')
+    parser.add_argument('--buffered-log', action='store_true',
+                        help='write the log in batches from a background thread, instead of '
+                        'writing and flushing it on every call')
+    parser.add_argument('--log-flush-interval', metavar='SECONDS', type=float, default=0.5,
+                        help='maximum delay until buffered log messages are written (default: 0.5)')
+    parser.add_argument('--call-log-capacity', metavar='N', type=int, default=0,
+                        help='maximum number of logged calls per object for GetCalls(); '
+                        'older calls get dropped (default: unlimited)')
+    parser.add_argument('--worker-threads', metavar='N', type=int, default=4,
+                        help='maximum number of threads for methods which run in a thread, '
+                        'see SetMethodThreaded() (default: 4)')
+    parser.add_argument('--state', metavar='FILE',
+                        help='load objects from a state file written by SaveState() at startup')
     parser.add_argument('name', metavar='NAME', nargs='?',
                         help='D-BUS name to claim (e. g. "com.example.MyService") (if not using -t)')
     parser.add_argument('path', metavar='PATH', nargs='?',
@@ -37,22 +63,31 @@ def parse_args():
 
     args = parser.parse_args()
 
+    if args.call_log_capacity < 0:
+        parser.error('--call-log-capacity must not be negative')
+    if args.worker_threads < 1:
+        parser.error('--worker-threads must be at least 1')
+
     if args.template:
         if args.name or args.path or args.interface:
             parser.error('--template and specifying NAME/PATH/INTERFACE are mutually exclusive')
+        if args.state:
+            parser.error('--template and --state are mutually exclusive; the state file already contains the template\'s objects')
     else:
         if not args.name or not args.path or not args.interface:
             parser.error('Not using a template, you must specify NAME, PATH, and INTERFACE')
 
-    return args
+    # also return the parser, for reporting errors in the state file
+    return (parser, args)
 
 
 if __name__ == '__main__':
     import importlib
+    import signal
     import dbus.mainloop.glib
     from gi.repository import GLib
 
-    args = parse_args()
+    (parser, args) = parse_args()
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 
     if args.template:
@@ -62,22 +97,43 @@ if __name__ == '__main__':
         args.interface = module.MAIN_IFACE
         args.system = module.SYSTEM_BUS
 
+    dbusmock.mockobject.call_log_capacity = args.call_log_capacity
+    dbusmock.mockobject.method_called_mode = args.method_called
+    dbusmock.mockobject.method_called_window = args.method_called_window
+    dbusmock.mockobject.log_level = dbusmock.mockobject.log_levels[args.log_level]
+    dbusmock.mockobject.log_buffered = args.buffered_log
+    dbusmock.mockobject.log_flush_interval = args.log_flush_interval
+    dbusmock.mockobject.worker_threads = args.worker_threads
+
     main_loop = GLib.MainLoop()
     bus = dbusmock.testcase.DBusTestCase.get_dbus(args.system)
 
     # quit mock when the bus is going down
     bus.add_signal_receiver(main_loop.quit, signal_name='Disconnected')
 
+    if args.buffered_log and hasattr(GLib, 'unix_signal_add'):
+        # shut down cleanly on SIGTERM, to write out the buffered log
+        GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM, main_loop.quit)
+
     bus_name = dbus.service.BusName(args.name,
                                     bus,
                                     allow_replacement=True,
                                     replace_existing=True,
                                     do_not_queue=True)
 
-    main_object = dbusmock.mockobject.DBusMockObject(bus_name, args.path, args.interface, {}, args.logfile)
+    main_object = dbusmock.mockobject.DBusMockObject(bus_name, args.path, args.interface, {}, args.logfile,
+                                                     args.is_object_manager)
 
     if args.template:
         main_object.AddTemplate(args.template, None)
 
     dbusmock.mockobject.objects[args.path] = main_object
+
+    if args.state:
+        try:
+            main_object.load_startup_state(args.state)
+        except dbus.exceptions.DBusException as e:
+            parser.error(e.get_dbus_message())
     main_loop.run()
+
+    dbusmock.mockobject.flush_logs()
@@ -15,6 +15,12 @@ __license__ = 'LGPL 3+'
 import time
 import sys
 import importlib
+import collections
+import itertools
+import threading
+import atexit
+import random
+import json
 
 # we do not use this ourselves, but mock methods often want to use this
 import os
@@ -22,11 +28,153 @@ os  # pyflakes
 
 import dbus
 import dbus.service
+import dbus.types
+import _dbus_bindings
+
+from gi.repository import GLib
+
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+
+class ObjectRegistry(dict):
+    '''Mapping of object paths to DBusMockObjects
+
+    This is a dict which additionally keeps an index of the object path tree,
+    so that the objects below a path can be found without looking at all
+    objects.
+    '''
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        # path -> set of paths of the direct child nodes; nodes without an
+        # object are kept as long as they have children
+        self._children = {}
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, path, obj):
+        if path not in self:
+            self._add_node(path)
+        dict.__setitem__(self, path, obj)
+
+    def __delitem__(self, path):
+        dict.__delitem__(self, path)
+        self._remove_node(path)
+
+    def pop(self, path, *default):
+        if path not in self:
+            return dict.pop(self, path, *default)
+        obj = dict.pop(self, path)
+        self._remove_node(path)
+        return obj
+
+    def popitem(self):
+        (path, obj) = dict.popitem(self)
+        self._remove_node(path)
+        return (path, obj)
+
+    def setdefault(self, path, default=None):
+        if path not in self:
+            self[path] = default
+        return dict.__getitem__(self, path)
+
+    def update(self, *args, **kwargs):
+        for (path, obj) in dict(*args, **kwargs).items():
+            self[path] = obj
+
+    def clear(self):
+        dict.clear(self)
+        self._children.clear()
+
+    def children(self, path):
+        '''Return sorted paths of the objects directly below path'''
+
+        return sorted(p for p in self._children.get(path, ()) if p in self)
+
+    def descendants(self, path):
+        '''Return sorted paths of the objects at or below path'''
+
+        result = []
+        nodes = [path]
+        while nodes:
+            node = nodes.pop()
+            if node in self:
+                result.append(node)
+            nodes.extend(self._children.get(node, ()))
+        result.sort()
+        return result
+
+    def _add_node(self, path):
+        while path != '/':
+            parent = path.rsplit('/', 1)[0] or '/'
+            siblings = self._children.setdefault(parent, set())
+            if path in siblings:
+                break
+            siblings.add(path)
+            path = parent
+
+    def _remove_node(self, path):
+        # drop nodes which have neither an object nor children
+        while path != '/' and path not in self and path not in self._children:
+            parent = path.rsplit('/', 1)[0] or '/'
+            siblings = self._children[parent]
+            siblings.remove(path)
+            if not siblings:
+                del self._children[parent]
+            path = parent
+
 
 # global path -> DBusMockObject mapping
-objects = {}
+objects = ObjectRegistry()
+
+# name -> Snapshot of all objects; see DBusMockObject.SaveSnapshot()
+snapshots = {}
 
 MOCK_IFACE = 'org.freedesktop.DBus.Mock'
+OBJECT_MANAGER_IFACE = 'org.freedesktop.DBus.ObjectManager'
+
+# default maximum number of entries in the call log of an object; 0 means
+# unlimited
+call_log_capacity = 0
+
+# whether to write logs in buffered mode by a background thread (see
+# LogWriter), and the maximum delay in seconds until they get written
+log_buffered = False
+log_flush_interval = 0.5
+
+# default mode and aggregation window (in ms) of the MethodCalled signal for
+# new objects; see DBusMockObject.SetMethodCalledMode()
+method_called_modes = ('signal', 'aggregate', 'off')
+method_called_mode = 'signal'
+method_called_window = 0
+
+# default for new objects whether to emit PropertiesChanged signals for
+# changed properties, and the time window (in ms) for merging changes into one
+# signal; see DBusMockObject.SetPropertiesChangedPolicy()
+properties_changed = True
+properties_changed_window = 0
+
+# number of worker threads for methods which run in a thread; see
+# DBusMockObject.SetMethodThreaded()
+worker_threads = 4
+
+# latency models for DBusMockObject.SetLatency(): name -> number of parameters
+latency_models = {'none': 0, 'fixed': 1, 'uniform': 2, 'normal': 2, 'exponential': 1}
+
+# file object -> LogWriter
+_log_writers = {}
+
+# log levels: nothing, only method/signal names, names and arguments
+# (abbreviating big arrays), names and complete arguments
+(LOG_OFF, LOG_CALLS, LOG_ARGS, LOG_FULL) = range(4)
+log_levels = {'off': LOG_OFF, 'calls': LOG_CALLS, 'args': LOG_ARGS, 'full': LOG_FULL}
+log_level = LOG_ARGS
+
+# arrays and dictionaries with more elements than this get abbreviated in
+# the log, unless the log level is LOG_FULL
+log_max_items = 1000
 
 # stubs to keep code compatible with Python 2 and 3
 if sys.version_info[0] >= 3:
@@ -48,6 +196,1078 @@ def load_module(name):
     return importlib.import_module('dbusmock.templates.' + name)
 
 
+def _template_name(module):
+    '''Return the name or file path of a template module for load_module()'''
+
+    prefix = 'dbusmock.templates.'
+    if module.__name__.startswith(prefix):
+        return module.__name__[len(prefix):]
+    # local template; __file__ might be the compiled module
+    return os.path.splitext(os.path.abspath(module.__file__))[0] + '.py'
+
+
+#
+# Type conversion of arguments according to a D-Bus signature
+#
+
+# integer type code -> (dbus type, minimum, maximum)
+_int_types = {
+    'y': (dbus.Byte, 0, 0xff),
+    'n': (dbus.Int16, -0x8000, 0x7fff),
+    'q': (dbus.UInt16, 0, 0xffff),
+    'i': (dbus.Int32, -0x80000000, 0x7fffffff),
+    'u': (dbus.UInt32, 0, 0xffffffff),
+    'x': (dbus.Int64, -0x8000000000000000, 0x7fffffffffffffff),
+    't': (dbus.UInt64, 0, 0xffffffffffffffff),
+}
+
+# other basic type code -> dbus type
+_basic_types = {
+    'b': dbus.Boolean,
+    'd': dbus.Double,
+    's': dbus.String,
+    'o': dbus.ObjectPath,
+    'g': dbus.Signature,
+}
+if hasattr(dbus.types, 'UnixFd'):
+    _basic_types['h'] = dbus.types.UnixFd
+
+# dbus type -> signature, for guessing the type of variants
+_type_signatures = dict([(t[0], code) for (code, t) in _int_types.items()] +
+                        [(t, code) for (code, t) in _basic_types.items()])
+if hasattr(dbus, 'UTF8String'):
+    _type_signatures[dbus.UTF8String] = 's'
+
+# signature -> function(value, variant_level) converting a single value
+_converters = {}
+# signature -> function(value) checking whether a value already has that type
+_checkers = {}
+# signature -> (converters, checkers) of an argument list
+_arg_converters = {}
+
+
+def _guess_signature(value, guess_empty=False):
+    '''Guess the signature of a single value, as dbus-python would do'''
+
+    if getattr(value, 'variant_level', 0) > 0:
+        return 'v'
+    return _signature_of(value, guess_empty)
+
+
+def _signature_of(value, guess_empty=False):
+    '''Return the signature of a single value, ignoring its variant level
+
+    Like dbus-python, this raises a ValueError for empty lists and
+    dictionaries without a signature, unless guess_empty is True; then they
+    are taken as "av" and "a{sv}".
+    '''
+    try:
+        return _type_signatures[type(value)]
+    except KeyError:
+        pass
+
+    if isinstance(value, dbus.ByteArray):
+        return 'ay'
+    if isinstance(value, bool):
+        return 'b'
+    if isinstance(value, long) and not isinstance(value, int):
+        # Python 2 long
+        return 'x'
+    if isinstance(value, int):
+        return 'i'
+    if isinstance(value, float):
+        return 'd'
+    if isinstance(value, (str, unicode, bytes)):
+        return 's'
+    if isinstance(value, dict):
+        sig = getattr(value, 'signature', None)
+        if not sig:
+            if value:
+                (k, v) = next(iter(value.items()))
+                sig = _guess_signature(k, guess_empty) + _guess_signature(v, guess_empty)
+            elif guess_empty:
+                sig = 'sv'
+            else:
+                raise ValueError('Unable to guess signature from an empty dict')
+        return 'a{%s}' % sig
+    if isinstance(value, list):
+        sig = getattr(value, 'signature', None)
+        if not sig:
+            if value:
+                sig = _guess_signature(value[0], guess_empty)
+            elif guess_empty:
+                sig = 'v'
+            else:
+                raise ValueError('Unable to guess signature from an empty list')
+        return 'a' + sig
+    if isinstance(value, tuple):
+        sig = getattr(value, 'signature', None)
+        if not sig:
+            sig = ''.join([_guess_signature(v, guess_empty) for v in value])
+        return '(%s)' % sig
+
+    raise TypeError('Don\'t know which D-Bus type to use to encode type "%s"' %
+                    type(value).__name__)
+
+
+def _get_converter(sig):
+    '''Return a (cached) converter function for a single complete type'''
+
+    try:
+        return _converters[sig]
+    except KeyError:
+        conv = _converters[sig] = _make_converter(sig)
+        return conv
+
+
+def _make_converter(sig):
+    code = sig[0]
+
+    if code in _int_types:
+        (cls, minimum, maximum) = _int_types[code]
+
+        def convert(value, level=0):
+            # like dbus-python, accept a single byte, but not a character
+            if code == 'y' and isinstance(value, bytes) and len(value) == 1:
+                value = ord(value)
+            if isinstance(value, float) or not isinstance(value, (int, long)):
+                raise TypeError('an integer is required')
+            if value < minimum:
+                if minimum == 0:
+                    raise OverflowError("can't convert negative value to unsigned int")
+                raise OverflowError('Value %i out of range for %s' % (value, cls.__name__))
+            if value > maximum:
+                raise OverflowError('Value %i out of range for %s' % (value, cls.__name__))
+            return cls(value, variant_level=level)
+        return convert
+
+    if code == 'd':
+        def convert(value, level=0):
+            if not isinstance(value, (int, long, float)):
+                raise TypeError('a float is required')
+            return dbus.Double(value, variant_level=level)
+        return convert
+
+    if code in 'sog':
+        cls = _basic_types[code]
+
+        def convert(value, level=0):
+            if isinstance(value, bytes) and not isinstance(value, str):
+                value = value.decode('UTF-8')
+            elif not isinstance(value, (str, unicode)):
+                raise TypeError('Expected a string or unicode object')
+            return cls(value, variant_level=level)
+        return convert
+
+    if code in _basic_types:
+        cls = _basic_types[code]
+        return lambda value, level=0: cls(value, variant_level=level)
+
+    if code == 'v':
+        def convert(value, level=0):
+            inner = _get_converter(_signature_of(value))
+            return inner(value, max(level, getattr(value, 'variant_level', 0), 1))
+        return convert
+
+    if sig.startswith('a{'):
+        (key_sig, value_sig) = [str(s) for s in dbus.Signature(sig[2:-1])]
+        conv_key = _get_converter(key_sig)
+        conv_value = _get_converter(value_sig)
+
+        def convert(value, level=0):
+            return dbus.Dictionary([(conv_key(k), conv_value(v)) for (k, v) in value.items()],
+                                   signature=sig[2:-1], variant_level=level)
+        return convert
+
+    if code == 'a':
+        conv_elem = _get_converter(sig[1:])
+
+        def convert(value, level=0):
+            return dbus.Array([conv_elem(v) for v in value],
+                              signature=sig[1:], variant_level=level)
+        return convert
+
+    if code == '(':
+        conv_fields = [_get_converter(str(s)) for s in dbus.Signature(sig[1:-1])]
+
+        def convert(value, level=0):
+            if len(value) < len(conv_fields):
+                raise TypeError("More items found in struct's D-Bus signature than in Python arguments")
+            if len(value) > len(conv_fields):
+                raise TypeError("Fewer items found in struct's D-Bus signature than in Python arguments")
+            return dbus.Struct([c(v) for (c, v) in zip(conv_fields, value)],
+                               variant_level=level)
+        return convert
+
+    raise ValueError('Invalid D-Bus signature "%s"' % sig)
+
+
+def _get_checker(sig):
+    '''Return a (cached) function checking a value's type for a single complete type
+
+    This returns True if the value already has exactly the type that the
+    converter would create, i. e. as dbus-python demarshals it.
+    '''
+    try:
+        return _checkers[sig]
+    except KeyError:
+        check = _checkers[sig] = _make_checker(sig)
+        return check
+
+
+def _make_checker(sig):
+    code = sig[0]
+
+    if code == 'v':
+        return lambda value: getattr(value, 'variant_level', 0) > 0 and \
+            (type(value) in _type_signatures or
+             (type(value) in (dbus.Array, dbus.Dictionary) and bool(value.signature)))
+
+    if code in _int_types or code in _basic_types:
+        cls = code in _int_types and _int_types[code][0] or _basic_types[code]
+        return lambda value: type(value) is cls and value.variant_level == 0
+
+    # containers are trusted if their signature matches; this is what
+    # dbus-python creates on demarshalling
+    if sig.startswith('a{'):
+        return lambda value: type(value) is dbus.Dictionary and \
+            value.signature == sig[2:-1] and value.variant_level == 0
+
+    if code == 'a':
+        return lambda value: type(value) is dbus.Array and \
+            value.signature == sig[1:] and value.variant_level == 0
+
+    if code == '(':
+        check_fields = [_get_checker(str(s)) for s in dbus.Signature(sig[1:-1])]
+        return lambda value: type(value) is dbus.Struct and value.variant_level == 0 and \
+            len(value) == len(check_fields) and \
+            all([c(v) for (c, v) in zip(check_fields, value)])
+
+    raise ValueError('Invalid D-Bus signature "%s"' % sig)
+
+
+def _convert_args(signature, args):
+    '''Convert arguments to the types given by a D-Bus signature
+
+    This does the same conversion and type/length checks as appending the
+    arguments to a D-Bus message and reading them back, but without the
+    marshalling. The converters are built once per signature. If all arguments
+    already have the right types (like the ones that dbus-python demarshals
+    from a method call), they are returned unchanged.
+
+    Return the list of converted arguments.
+    '''
+    try:
+        (convs, checks) = _arg_converters[signature]
+    except KeyError:
+        types = [str(s) for s in dbus.Signature(signature)]
+        convs = [_get_converter(s) for s in types]
+        checks = [_get_checker(s) for s in types]
+        _arg_converters[signature] = (convs, checks)
+
+    if len(args) < len(convs):
+        raise TypeError('More items found in D-Bus signature than in Python arguments')
+    if len(args) > len(convs):
+        raise TypeError('Fewer items found in D-Bus signature than in Python arguments')
+
+    for (check, arg) in zip(checks, args):
+        if not check(arg):
+            return [conv(a) for (conv, a) in zip(convs, args)]
+    return list(args)
+
+
+#
+# JSON representation of D-Bus values, for state files
+#
+
+# signature -> function(value) returning a value which json can write
+_json_dumpers = {}
+# signature -> function(json_value, variant_level) returning a D-Bus value
+_json_loaders = {}
+
+
+def _get_json_dumper(sig):
+    '''Return a (cached) JSON dumper function for a single complete type'''
+
+    try:
+        return _json_dumpers[sig]
+    except KeyError:
+        dump = _json_dumpers[sig] = _make_json_dumper(sig)
+        return dump
+
+
+def _make_json_dumper(sig):
+    code = sig[0]
+
+    if code == 'y':
+        def dump(value):
+            # elements of Python 2 byte strings
+            if isinstance(value, (bytes, str)):
+                return ord(value)
+            return int(value)
+        return dump
+    if code in _int_types:
+        return int
+    if code == 'b':
+        return bool
+    if code == 'd':
+        return float
+    if code in 'sog':
+        return unicode
+    if code == 'h':
+        raise ValueError('file descriptors cannot be saved')
+
+    if code == 'v':
+        # variants carry the signature of their value
+        def dump(value):
+            inner = _signature_of(value, True)
+            return [inner, _get_json_dumper(inner)(value)]
+        return dump
+
+    if sig.startswith('a{'):
+        (key_sig, value_sig) = [str(s) for s in dbus.Signature(sig[2:-1])]
+        dump_value = _get_json_dumper(value_sig)
+        # JSON objects can only have string keys; use a list of pairs otherwise
+        if key_sig in 'sog':
+            return lambda value: dict((unicode(k), dump_value(v)) for (k, v) in value.items())
+        dump_key = _get_json_dumper(key_sig)
+        return lambda value: [[dump_key(k), dump_value(v)] for (k, v) in value.items()]
+
+    if code == 'a':
+        dump_elem = _get_json_dumper(sig[1:])
+        return lambda value: [dump_elem(v) for v in value]
+
+    if code == '(':
+        dump_fields = [_get_json_dumper(str(s)) for s in dbus.Signature(sig[1:-1])]
+        return lambda value: [d(v) for (d, v) in zip(dump_fields, value)]
+
+    raise ValueError('Invalid D-Bus signature "%s"' % sig)
+
+
+def _get_json_loader(sig):
+    '''Return a (cached) JSON loader function for a single complete type'''
+
+    try:
+        return _json_loaders[sig]
+    except KeyError:
+        load = _json_loaders[sig] = _make_json_loader(sig)
+        return load
+
+
+def _make_json_loader(sig):
+    code = sig[0]
+
+    if code in _int_types or code in _basic_types:
+        return _get_converter(sig)
+
+    if code == 'v':
+        def load(value, level=0):
+            (inner, inner_value) = value
+            return _get_json_loader(inner)(inner_value, max(level, 1))
+        return load
+
+    if sig.startswith('a{'):
+        (key_sig, value_sig) = [str(s) for s in dbus.Signature(sig[2:-1])]
+        load_key = _get_json_loader(key_sig)
+        load_value = _get_json_loader(value_sig)
+
+        def load(value, level=0):
+            items = isinstance(value, dict) and value.items() or value
+            return dbus.Dictionary([(load_key(k), load_value(v)) for (k, v) in items],
+                                   signature=sig[2:-1], variant_level=level)
+        return load
+
+    if code == 'a':
+        load_elem = _get_json_loader(sig[1:])
+        return lambda value, level=0: dbus.Array([load_elem(v) for v in value],
+                                                 signature=sig[1:], variant_level=level)
+
+    if code == '(':
+        load_fields = [_get_json_loader(str(s)) for s in dbus.Signature(sig[1:-1])]
+
+        def load(value, level=0):
+            if len(value) != len(load_fields):
+                raise TypeError('struct "%s" needs %i fields' % (sig, len(load_fields)))
+            return dbus.Struct([l(v) for (l, v) in zip(load_fields, value)],
+                               signature=sig[1:-1], variant_level=level)
+        return load
+
+    raise ValueError('Invalid D-Bus signature "%s"' % sig)
+
+
+def _function_name(fn):
+    '''Return the "module.name" of a module level function'''
+
+    module = sys.modules.get(getattr(fn, '__module__', None))
+    name = getattr(fn, '__name__', '')
+    if module is None or getattr(module, name, None) is not fn:
+        raise ValueError('%r is not a module level function' % fn)
+    return '%s.%s' % (fn.__module__, name)
+
+
+def _import_function(name):
+    '''Return the function for a _function_name() result'''
+
+    (module, name) = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module), name)
+
+
+def _parse_state(state, code_cache):
+    '''Load the state of an object from _dump_state()
+
+    This imports the templates and functions, compiles the method code, and
+    converts all values, without changing any object; an invalid state raises
+    an exception here. Apply the result with DBusMockObject._load_state().
+
+    code_cache is a (code, interface, name) -> code object map, so that
+    the same method code on many objects only gets compiled once.
+    '''
+    if (not isinstance(state, dict) or not isinstance(state.get('path'), (str, unicode)) or
+            not isinstance(state.get('interface'), (str, unicode))):
+        raise ValueError('object entry without path and interface: %s' % json.dumps(state))
+
+    load_variant = _get_json_loader('v')
+    load_params = _get_json_loader('a{sv}')
+    templates = [(load_module(template), load_params(parameters))
+                 for (template, parameters) in state.get('templates', [])]
+
+    props = dict((iface, dict((name, load_variant(value)) for (name, value) in iface_props.items()))
+                 for (iface, iface_props) in state.get('properties', {}).items())
+
+    methods = []
+    for (iface, iface_methods) in state.get('methods', {}).items():
+        for (name, (in_sig, out_sig, code)) in iface_methods.items():
+            # check the signatures, so that adding the method cannot fail
+            len(dbus.Signature(in_sig))
+            len(dbus.Signature(out_sig))
+            if isinstance(code, dict):
+                code = code_object = _import_function(code['function'])
+            elif code:
+                key = (code, iface, name)
+                code_object = code_cache.get(key)
+                if code_object is None:
+                    code_object = code_cache[key] = compile(code, '<%s.%s>' % (iface, name), 'exec')
+            else:
+                code_object = None
+            methods.append((iface, name, in_sig, out_sig, code, code_object))
+
+    attrs = dict((name, _get_json_loader(sig)(value))
+                 for (name, (sig, value)) in state.get('attributes', {}).items())
+
+    return (templates, props, methods, attrs)
+
+
+def _format_arg(a, max_items):
+    '''Format a single D-BUS argument for logging
+
+    Arrays and dictionaries with more than max_items elements get abbreviated,
+    unless max_items is 0.
+    '''
+    if isinstance(a, dbus.Boolean):
+        return str(bool(a))
+    if isinstance(a, dbus.Byte):
+        return str(int(a))
+    if isinstance(a, (int, long)):
+        return str(a)
+    if isinstance(a, (str, unicode)):
+        return '"' + str(a) + '"'
+    if isinstance(a, list):
+        if max_items and len(a) > max_items:
+            if getattr(a, 'signature', None) == 'y':
+                return '<%i bytes>' % len(a)
+            return '[%s, ... (%i items)]' % (
+                ', '.join([_format_arg(x, max_items) for x in a[:10]]), len(a))
+        return '[' + ', '.join([_format_arg(x, max_items) for x in a]) + ']'
+    if isinstance(a, dict):
+        if max_items and len(a) > max_items:
+            return '{%s, ... (%i items)}' % (
+                ', '.join([_format_arg(k, max_items) + ': ' + _format_arg(v, max_items)
+                           for (k, v) in itertools.islice(a.items(), 10)]), len(a))
+        return '{' + ', '.join([_format_arg(k, max_items) + ': ' + _format_arg(v, max_items)
+                                for (k, v) in a.items()]) + '}'
+    if max_items and isinstance(a, bytes) and len(a) > max_items:
+        return '<%i bytes>' % len(a)
+
+    # fallback
+    return repr(a)
+
+
+class LogWriter(object):
+    '''Write log messages with time stamps to a file object
+
+    In immediate mode (the default) every message gets written and flushed
+    right away. In buffered mode, messages get queued and written out in
+    batches by a background thread, so that method calls do not have to wait
+    for the disk; the file gets flushed when max_batch messages are pending,
+    flush_interval seconds after the first pending message, and on flush().
+    '''
+    def __init__(self, fd, buffered=False, flush_interval=0.5, max_batch=1000):
+        self.fd = fd
+        self.buffered = buffered
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        if buffered:
+            self.queue = queue.Queue()
+            self.thread = threading.Thread(target=self._run, name='dbusmock log writer')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def write(self, msg):
+        '''Log a message, prefixed with the current time stamp'''
+
+        line = '%.3f %s\n' % (time.time(), msg)
+        if self.buffered:
+            self.queue.put(line)
+        else:
+            self.fd.write(line)
+            self.fd.flush()
+
+    def flush(self):
+        '''Write out all pending messages and flush the file
+
+        This blocks until everything is written.
+        '''
+        if self.buffered and self.thread.is_alive():
+            done = threading.Event()
+            self.queue.put(done)
+            done.wait()
+        else:
+            self.fd.flush()
+
+    def close(self):
+        '''Write out all pending messages and stop the writer thread
+
+        Further messages are written in immediate mode.
+        '''
+        if self.buffered:
+            self.buffered = False
+            self.queue.put(None)
+            self.thread.join()
+
+    def _run(self):
+        pending = []
+        deadline = None
+        while True:
+            try:
+                if pending:
+                    item = self.queue.get(timeout=max(deadline - time.time(), 0))
+                else:
+                    item = self.queue.get()
+            except queue.Empty:
+                # flush interval is over
+                item = False
+
+            if isinstance(item, (str, unicode)):
+                if not pending:
+                    deadline = time.time() + self.flush_interval
+                pending.append(item)
+                if len(pending) < self.max_batch:
+                    continue
+
+            # write out on timeout, full batch, flush request (Event), or
+            # stop request (None)
+            try:
+                if pending:
+                    self.fd.write(''.join(pending))
+                self.fd.flush()
+            except (IOError, OSError, ValueError) as e:
+                sys.stderr.write('dbusmock: cannot write log: %s\n' % str(e))
+            pending = []
+
+            if item is None:
+                return
+            if isinstance(item, threading.Event):
+                item.set()
+
+
+def get_log_writer(fd):
+    '''Return the LogWriter for a file object
+
+    This gets created on first use, with the current log_buffered and
+    log_flush_interval settings.
+    '''
+    try:
+        return _log_writers[fd]
+    except KeyError:
+        writer = _log_writers[fd] = LogWriter(fd, log_buffered, log_flush_interval)
+        return writer
+
+
+def flush_logs():
+    '''Write out all pending log messages
+
+    This is only necessary when using buffered logging.
+    '''
+    for writer in list(_log_writers.values()):
+        writer.flush()
+
+
+atexit.register(flush_logs)
+
+
+def _make_signal_emitter(interface, name, signature, n_args):
+    '''Build a dbus-python signal function for EmitSignal()'''
+
+    fn = lambda self, *args: log_level and self.log_call('emit %s.%s' % (interface, name), args)
+    fn.__name__ = str(name)
+    dbus_fn = dbus.service.signal(interface)(fn)
+    dbus_fn._dbus_signature = signature
+    dbus_fn._dbus_args = ['arg%i' % i for i in range(1, n_args + 1)]
+    return dbus_fn
+
+
+def _invalidate_ancestors(path):
+    '''Drop cached introspection data of all mock objects above path
+
+    Their Introspect() output lists their children, so it changes when an
+    object gets added or removed.
+    '''
+    while path != '/':
+        path = path.rsplit('/', 1)[0] or '/'
+        obj = objects.get(path)
+        if obj is not None:
+            obj._invalidate_introspection()
+
+
+class CallLogEntry(object):
+    '''A single logged method call'''
+
+    __slots__ = ('seq', 'timestamp', 'method', 'args', 'latency', 'reply_latency')
+
+    def __init__(self, seq, timestamp, method, args):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.method = method
+        self.args = args
+        # injected latency, and actual time until the reply was sent (None if
+        # not answered yet), in seconds
+        self.latency = 0.0
+        self.reply_latency = None
+
+
+class CallLog(object):
+    '''Log of method calls on a mock object
+
+    This keeps at most "capacity" entries (0 means unlimited) in a ring
+    buffer; when it is full, the oldest entries get evicted, and counted in
+    "dropped". There is an additional index of entries by method name, for
+    cheap queries of the calls of a particular method.
+
+    Each entry gets a sequence number which increases monotonically over the
+    whole life time of the log (also across clear()), so that clients can
+    incrementally fetch new entries.
+    '''
+    def __init__(self, capacity=0):
+        self.entries = collections.deque()
+        self.last_seq = 0
+        # method name -> deque of entries
+        self.by_method = {}
+        self.capacity = capacity
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def append(self, method, args):
+        '''Log a call of method with given arguments
+
+        Return the new CallLogEntry.
+        '''
+
+        if self.capacity and len(self.entries) >= self.capacity:
+            self._evict()
+        self.last_seq += 1
+        entry = CallLogEntry(self.last_seq, int(time.time()), method, args)
+        self.entries.append(entry)
+        try:
+            self.by_method[method].append(entry)
+        except KeyError:
+            self.by_method[method] = collections.deque([entry])
+        return entry
+
+    def entries_since(self, seq, max_count=0):
+        '''Return the entries after sequence number seq
+
+        Return at most max_count entries (0 means unlimited), starting with the
+        oldest. This takes time proportional to the number of new entries (or
+        the number of older entries, if that is smaller), not the whole log.
+        '''
+        if not self.entries:
+            return []
+        # sequence numbers in the log are contiguous
+        offset = max(seq + 1 - self.entries[0].seq, 0)
+        n_new = len(self.entries) - offset
+        if n_new <= 0:
+            return []
+        if max_count and max_count < n_new:
+            end = offset + max_count
+        else:
+            end = len(self.entries)
+
+        if n_new <= offset:
+            # cheaper to walk from the end
+            new = list(itertools.islice(reversed(self.entries), n_new))
+            new.reverse()
+            return new[:end - offset]
+        return list(itertools.islice(self.entries, offset, end))
+
+    def method_entries(self, method):
+        '''Return the entries for the calls of a particular method'''
+
+        return self.by_method.get(method, ())
+
+    def method_count(self, method):
+        '''Return the number of logged calls of a particular method'''
+
+        return len(self.by_method.get(method, ()))
+
+    def clear(self):
+        '''Remove all entries, and reset the dropped counter'''
+
+        self.entries.clear()
+        self.by_method.clear()
+        self.dropped = 0
+
+    def set_capacity(self, capacity):
+        '''Change the maximum number of entries (0 means unlimited)
+
+        If there are more entries than that, the oldest ones get evicted.
+        '''
+        self.capacity = capacity
+        while capacity and len(self.entries) > capacity:
+            self._evict()
+
+    def _evict(self):
+        entry = self.entries.popleft()
+        # the oldest entry overall is also the oldest one of its method
+        method_entries = self.by_method[entry.method]
+        method_entries.popleft()
+        if not method_entries:
+            del self.by_method[entry.method]
+        self.dropped += 1
+
+
+def _sample_latency(rng, model, params):
+    '''Return a random latency in seconds for a latency model
+
+    params are in milliseconds, see DBusMockObject.SetLatency().
+    '''
+    if model == 'fixed':
+        ms = params[0]
+    elif model == 'uniform':
+        ms = rng.uniform(params[0], params[1])
+    elif model == 'normal':
+        ms = rng.gauss(params[0], params[1])
+    elif model == 'exponential':
+        ms = params[0] and rng.expovariate(1.0 / params[0])
+    else:
+        ms = 0
+    return max(ms, 0) / 1000.0
+
+
+def _timed_callback(entry, start, delay, cb, error_cb=None):
+    '''Wrap a reply callback of a method call
+
+    The returned function records the actual reply latency in the call log
+    entry, and sends the reply after delay seconds. If cb fails (e. g. because
+    the return value does not match the signature), the exception gets sent
+    with error_cb instead, so that the caller does not wait in vain.
+    '''
+    def send(*args):
+        entry.reply_latency = time.time() - start
+        try:
+            cb(*args)
+        except Exception as e:
+            if error_cb is None:
+                raise
+            error_cb(e)
+        return False
+
+    if not delay:
+        return send
+    return lambda *args: GLib.timeout_add(int(delay * 1000), send, *args) and None
+
+
+def _reply_args(name, signature, n_args, ret):
+    '''Turn a method return value into the list of reply arguments
+
+    This does the same checks as dbus-python does for methods which return
+    their value directly. n_args is the number of types in signature.
+    '''
+    if n_args == 0:
+        if ret is not None:
+            raise TypeError('%s has an empty output signature but did not return None' % name)
+        return ()
+    if n_args == 1:
+        return (ret,)
+    if not isinstance(ret, (tuple, list)):
+        raise TypeError('%s has multiple output values in signature %s but did not return a sequence' %
+                        (name, signature))
+    return ret
+
+
+class DeferredReply(object):
+    '''Handle for answering a method call later
+
+    Mock methods get this from DBusMockObject.defer_reply() and return it.
+    Calling reply() or error() later, e. g. from a GLib timeout, sends the
+    answer to the caller.
+    '''
+    def __init__(self):
+        self.answered = False
+        # (reply_args, reply_cb, error_cb), once the method returned
+        self._callbacks = None
+        # (success, value) if answered before the method returned
+        self._result = None
+
+    def reply(self, ret=None):
+        '''Send the return value of the method call'''
+
+        self._finish(True, ret)
+
+    def error(self, exception):
+        '''Send an error (e. g. a DBusException) as the method call result'''
+
+        self._finish(False, exception)
+
+    def _bind(self, reply_args, reply_cb, error_cb):
+        self._callbacks = (reply_args, reply_cb, error_cb)
+        if self._result:
+            self._send(*self._result)
+
+    def _finish(self, success, value):
+        if self.answered:
+            raise RuntimeError('method call was already answered')
+        self.answered = True
+        if self._callbacks:
+            self._send(success, value)
+        else:
+            self._result = (success, value)
+
+    def _send(self, success, value):
+        (reply_args, reply_cb, error_cb) = self._callbacks
+        if success:
+            try:
+                reply_cb(*reply_args(value))
+                return
+            except Exception as e:
+                value = e
+        error_cb(value)
+
+
+class WorkerPool(object):
+    '''Bounded pool of threads for running expensive mock methods
+
+    Jobs wait in a queue until one of at most "size" threads is free. Their
+    result gets passed to a callback in the main loop.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.jobs = queue.Queue()
+        self.threads = []
+        # protects the counters
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.max_queued = 0
+
+    def submit(self, fn, done):
+        '''Run fn() in a worker thread
+
+        Then call done(True, result), or done(False, exception) if fn raised an
+        exception, in the main loop.
+        '''
+        with self.lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+            # start threads on demand
+            start_thread = len(self.threads) < self.size
+            if start_thread:
+                t = threading.Thread(target=self._run, name='dbusmock worker %i' % len(self.threads))
+                t.daemon = True
+                self.threads.append(t)
+        if start_thread:
+            t.start()
+        self.jobs.put((fn, done))
+
+    def info(self):
+        '''Return statistics as a D-Bus a{sv} dictionary'''
+
+        with self.lock:
+            return dbus.Dictionary({
+                'threads': dbus.UInt32(self.size),
+                'queued': dbus.UInt32(self.queued),
+                'running': dbus.UInt32(self.running),
+                'completed': dbus.UInt64(self.completed),
+                'max_queued': dbus.UInt32(self.max_queued),
+            }, signature='sv')
+
+    def _run(self):
+        while True:
+            (fn, done) = self.jobs.get()
+            with self.lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                result = (True, fn())
+            except Exception as e:
+                result = (False, e)
+            with self.lock:
+                self.running -= 1
+                self.completed += 1
+            GLib.idle_add(self._deliver, done, result)
+
+    @staticmethod
+    def _deliver(done, result):
+        done(*result)
+        return False
+
+
+_worker_pool = None
+_main_thread = threading.current_thread()
+
+
+def get_worker_pool():
+    '''Return the WorkerPool for threaded methods
+
+    This gets created on first use, with the current worker_threads setting.
+    '''
+    global _worker_pool
+    if _worker_pool is None:
+        _worker_pool = WorkerPool(worker_threads)
+    return _worker_pool
+
+
+class SignalStream(object):
+    '''Periodic emission of a signal from the GLib main loop
+
+    emit is called with an argument list for every signal, rotating through
+    arg_sets. The stream stops after count signals or duration seconds,
+    whichever comes first; if both are 0, it runs until stop() is called.
+    '''
+    # maximum number of signals to emit in one main loop iteration when
+    # catching up with the schedule, so that method calls still get handled
+    max_batch = 100
+
+    def __init__(self, emit, arg_sets, rate, count=0, duration=0):
+        self.emit = emit
+        self.arg_sets = arg_sets
+        self.rate = float(rate)
+        # number of signals to emit, None for unlimited
+        self.total = count or None
+        if duration:
+            n = int(duration * self.rate)
+            self.total = n if self.total is None else min(self.total, n)
+        self.emitted = 0
+        # how far (in seconds) the emitted signals are behind the schedule
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.start_time = time.time()
+        self.end_time = None
+        self._source = GLib.timeout_add(max(1, int(1000 / self.rate)), self._tick)
+
+    def _tick(self):
+        now = time.time()
+        due = int((now - self.start_time) * self.rate) + 1
+        if self.total is not None:
+            due = min(due, self.total)
+
+        for i in range(min(due - self.emitted, self.max_batch)):
+            self.emit(self.arg_sets[self.emitted % len(self.arg_sets)])
+            self.emitted += 1
+
+        if self.emitted < due:
+            self.lag = now - (self.start_time + self.emitted / self.rate)
+        else:
+            self.lag = 0.0
+        self.max_lag = max(self.max_lag, self.lag)
+
+        if self.total is not None and self.emitted >= self.total:
+            self.end_time = time.time()
+            self._source = None
+            return False
+        return True
+
+    def stop(self):
+        '''Stop emitting signals'''
+
+        if self._source:
+            GLib.source_remove(self._source)
+            self._source = None
+            self.end_time = time.time()
+
+    def info(self):
+        '''Return statistics as a D-Bus a{sv} dictionary'''
+
+        elapsed = (self.end_time or time.time()) - self.start_time
+        return dbus.Dictionary({
+            'running': dbus.Boolean(self._source is not None),
+            'emitted': dbus.UInt64(self.emitted),
+            'elapsed': dbus.Double(elapsed),
+            'rate': dbus.Double(elapsed and self.emitted / elapsed),
+            'lag': dbus.Double(self.lag),
+            'max_lag': dbus.Double(self.max_lag),
+        }, signature='sv')
+
+
+def _copy_state(value):
+    '''Copy the containers in object state
+
+    This copies lists, dicts, sets, and D-Bus arrays and dictionaries.
+    Everything else, like strings, numbers, and structs, is shared between
+    the copies: mock code replaces such values instead of changing them in
+    place.
+    '''
+    t = type(value)
+    if t is dict:
+        return dict((k, _copy_state(v)) for (k, v) in value.items())
+    if t is list:
+        return [_copy_state(v) for v in value]
+    if t is set:
+        return set(value)
+    if t is dbus.Array:
+        return dbus.Array([_copy_state(v) for v in value], signature=value.signature,
+                          variant_level=value.variant_level)
+    if t is dbus.Dictionary:
+        return dbus.Dictionary([(k, _copy_state(v)) for (k, v) in value.items()],
+                               signature=value.signature, variant_level=value.variant_level)
+    return value
+
+
+class Snapshot(object):
+    '''State of all mock objects at some point in time
+
+    This keeps the object instances themselves, so that restore() can put
+    back removed objects without creating new ones, and restores the state of
+    every object in place.
+    '''
+    def __init__(self):
+        # path -> (object, connection, state)
+        self.objects = {}
+        for (path, obj) in objects.items():
+            self.objects[path] = (obj, obj.connection, obj._save_state())
+
+    def restore(self):
+        '''Make the mock objects look like when the snapshot was taken'''
+
+        for (path, obj) in list(objects.items()):
+            saved = self.objects.get(path)
+            if saved is None or saved[0] is not obj:
+                objects.pop(path)
+                obj._stop_sources()
+                obj.remove_from_connection()
+
+        for (path, (obj, connection, state)) in self.objects.items():
+            obj._restore_state(state)
+            if path not in objects:
+                obj.add_to_connection(connection, path)
+                objects[path] = obj
+
+
 class DBusMockObject(dbus.service.Object):
     '''Mock D-Bus object
 
@@ -56,7 +1276,8 @@ class DBusMockObject(dbus.service.Object):
     that you can control the mock from any programming language.
     '''
 
-    def __init__(self, bus_name, path, interface, props, logfile=None):
+    def __init__(self, bus_name, path, interface, props, logfile=None,
+                 is_object_manager=False):
         '''Create a new DBusMockObject
 
         bus_name: A dbus.service.BusName instance where the object will be put on
@@ -69,41 +1290,193 @@ class DBusMockObject(dbus.service.Object):
                  if None, logging will be written to stdout. Note that you can
                  also query the called methods over D-BUS with GetCalls() and
                  GetMethodCalls().
+        is_object_manager: If True, the object provides the
+                           org.freedesktop.DBus.ObjectManager interface for all
+                           objects below it.
         '''
-        super(self.__class__, self).__init__(bus_name, path)
+        super(DBusMockObject, self).__init__(bus_name, path)
 
         self.bus_name = bus_name
+        self.path = path
         self.interface = interface
-        # interface -> name -> value
-        self.props = {}
-        self.props[interface] = props
-
-        # interface -> name -> (in_signature, out_signature, code, dbus_wrapper_fn)
-        self.methods = {interface: {}}
+        # initial properties, for Reset()
+        self._initial_props = dict(props)
 
         if logfile:
             self.logfile = open(logfile, 'w')
         else:
             self.logfile = None
-        self.call_log = []
+        self.log_writer = get_log_writer(self.logfile or sys.stdout)
+        self.call_log = CallLog(call_log_capacity)
+
+        # (module, parameters) of the loaded templates, for Reset()
+        self._templates = []
+        # parsed state file from load_startup_state(), for Reset()
+        self._startup_state = None
+
+        # id -> SignalStream
+        self._signal_streams = {}
+        self._signal_stream_ids = itertools.count(1)
+
+        self.is_object_manager = is_object_manager
+
+        self._init_state(props)
+        # everything else (e. g. state of templates) gets dropped in Reset()
+        self._base_attributes = frozenset(self.__dict__) | set(['_base_attributes'])
+
+    # attributes which snapshots save, in addition to the ones added by
+    # templates; see _save_state()
+    _snapshot_attributes = ('props', 'methods', 'method_called_mode', 'method_called_window',
+                            'properties_changed', 'properties_changed_window', 'latency',
+                            'latency_default', 'threaded_methods', '_templates')
+
+    def _init_state(self, props):
+        '''Set up the properties, methods, and settings of the object
+
+        This is the state which Reset() restores.
+        '''
+        # interface -> name -> value
+        self.props = {self.interface: props}
+
+        # interface -> name -> (in_signature, out_signature, code, dbus_wrapper_fn, code_object,
+        #                       number of out arguments)
+        self.methods = {self.interface: {}}
+
+        self.method_called_mode = method_called_mode
+        self.method_called_window = method_called_window
+        # pending calls for MethodsCalled in "aggregate" mode
+        self._method_calls = []
+        self._method_called_source = None
+
+        self.properties_changed = properties_changed
+        self.properties_changed_window = properties_changed_window
+        # interface -> name -> value of changes for the next PropertiesChanged
+        self._changed_props = {}
+        self._changed_props_source = None
+
+        # object path -> cached Introspect() result
+        self._introspection_xml = {}
+
+        # (interface, method name) -> (model, params) for SetLatency(), and
+        # the default for all other methods
+        self.latency = {}
+        self.latency_default = None
+        self.latency_random = random.Random()
+
+        # (interface, method name) of methods which run in the worker pool
+        self.threaded_methods = set()
+
+        # (interface, name, signature) -> signal function for EmitSignal()
+        self._signal_emitters = {}
+
+        if self.is_object_manager:
+            cls = self._object_class()
+            for fn in (GetManagedObjects, InterfacesAdded, InterfacesRemoved):
+                setattr(cls, fn.__name__, fn)
 
     def __del__(self):
-        if self.logfile:
+        # __init__() might have failed early, e. g. for an invalid path
+        if getattr(self, 'logfile', None):
+            self.log_writer.close()
+            _log_writers.pop(self.logfile, None)
             self.logfile.close()
 
-    @dbus.service.method(dbus.PROPERTIES_IFACE,
-                         in_signature='ss', out_signature='v')
-    def Get(self, interface_name, property_name):
-        '''Standard D-Bus API for getting a property value'''
+    def get_property(self, interface, name):
+        '''Return the value of a property
 
-        if not interface_name:
-            interface_name = self.interface
+        This is the same as the D-Bus Get() method, but can be used by
+        templates and mock method code to avoid the D-Bus method wrappers.
+        For convenience you can specify '' as interface for the object's main
+        interface.
+        '''
         try:
-            return self.GetAll(interface_name)[property_name]
+            return self.props[interface or self.interface][name]
         except KeyError:
+            if (interface or self.interface) not in self.props:
+                raise dbus.exceptions.DBusException(
+                    self.interface + '.UnknownInterface',
+                    'no such interface ' + (interface or self.interface))
             raise dbus.exceptions.DBusException(
                 self.interface + '.UnknownProperty',
-                'no such property ' + property_name)
+                'no such property ' + name)
+
+    def set_property(self, interface, name, value):
+        '''Change the value of an existing property
+
+        This is the same as the D-Bus Set() method, but can be used by
+        templates and mock method code to avoid the D-Bus method wrappers.
+        For convenience you can specify '' as interface for the object's main
+        interface. Like Set(), this emits a PropertiesChanged signal unless
+        that is disabled with SetPropertiesChangedPolicy().
+        '''
+        try:
+            iface_props = self.props[interface or self.interface]
+        except KeyError:
+            raise dbus.exceptions.DBusException(
+                self.interface + '.UnknownInterface',
+                'no such interface ' + (interface or self.interface))
+
+        if name not in iface_props:
+            raise dbus.exceptions.DBusException(
+                self.interface + '.UnknownProperty',
+                'no such property ' + name)
+
+        iface_props[name] = value
+        if self.properties_changed:
+            self._queue_property_changed(interface or self.interface, name, value)
+
+    def _queue_property_changed(self, interface, name, value):
+        '''Queue a changed property for the next PropertiesChanged signal'''
+
+        self._changed_props.setdefault(interface, {})[name] = value
+        if not self._changed_props_source:
+            if self.properties_changed_window:
+                self._changed_props_source = GLib.timeout_add(
+                    self.properties_changed_window, self._emit_properties_changed)
+            else:
+                self._changed_props_source = GLib.idle_add(self._emit_properties_changed)
+
+    def _emit_properties_changed(self):
+        changed = self._changed_props
+        self._changed_props = {}
+        self._changed_props_source = None
+        for (interface, props) in changed.items():
+            self.PropertiesChanged(interface, props, [])
+        return False
+
+    @dbus.service.signal(dbus.PROPERTIES_IFACE, signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed_properties, invalidated_properties):
+        if log_level:
+            self.log_call('emit %s.PropertiesChanged' % dbus.PROPERTIES_IFACE,
+                          (interface, changed_properties))
+
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='bu',
+                         out_signature='')
+    def SetPropertiesChangedPolicy(self, enabled, window):
+        '''Configure the PropertiesChanged signal of this object.
+
+        enabled: Whether to emit org.freedesktop.DBus.Properties.PropertiesChanged
+                 when properties get changed with Set() (default: True).
+        window: The time in milliseconds for collecting changes into one
+                signal per interface; with 0 (the default), the signal gets
+                emitted as soon as the main loop is idle, i. e. it contains all
+                changes which happened in one main loop iteration.
+        '''
+        # deliver pending changes with the old settings
+        if self._changed_props_source:
+            GLib.source_remove(self._changed_props_source)
+            self._emit_properties_changed()
+
+        self.properties_changed = enabled
+        self.properties_changed_window = window
+
+    @dbus.service.method(dbus.PROPERTIES_IFACE,
+                         in_signature='ss', out_signature='v')
+    def Get(self, interface_name, property_name):
+        '''Standard D-Bus API for getting a property value'''
+
+        return self.get_property(interface_name, property_name)
 
     @dbus.service.method(dbus.PROPERTIES_IFACE,
                          in_signature='s', out_signature='a{sv}')
@@ -124,19 +1497,7 @@ class DBusMockObject(dbus.service.Object):
     def Set(self, interface_name, property_name, value, *args, **kwargs):
         '''Standard D-Bus API for setting a property value'''
 
-        try:
-            iface_props = self.props[interface_name]
-        except KeyError:
-            raise dbus.exceptions.DBusException(
-                self.interface + '.UnknownInterface',
-                'no such interface ' + interface_name)
-
-        if property_name not in iface_props:
-            raise dbus.exceptions.DBusException(
-                self.interface + '.UnknownProperty',
-                'no such property ' + property_name)
-
-        iface_props[property_name] = value
+        self.set_property(interface_name, property_name, value)
 
     @dbus.service.method(MOCK_IFACE,
                          in_signature='ssa{sv}a(ssss)',
@@ -170,13 +1531,73 @@ class DBusMockObject(dbus.service.Object):
                 'org.freedesktop.DBus.Mock.NameError',
                 'object %s already exists' % path)
 
+        obj = self._create_object(path, interface, properties, methods)
+        objects[path] = obj
+        _invalidate_ancestors(path)
+
+        manager = _object_manager(path)
+        if manager:
+            manager.InterfacesAdded(dbus.ObjectPath(path), obj.props)
+
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='a(ssa{sv}a(ssss))b',
+                         out_signature='as')
+    def AddObjects(self, new_objects, emit_signals):
+        '''Add several new D-Bus objects to the mock
+
+        new_objects: An array of 4-tuples (path, interface, properties,
+                     methods) describing one object each; see AddObject() for
+                     details of the tuple values
+        emit_signals: If False, do not emit InterfacesAdded signals for the
+                      new objects. Otherwise they get emitted after all
+                      objects were created.
+
+        This creates all valid objects even if some entries fail. Return an
+        array with an error message for each entry, which is empty if the
+        object was created successfully.
+        '''
+        created = collections.OrderedDict()
+        errors = []
+        for (path, interface, properties, methods) in new_objects:
+            if path in objects or path in created:
+                errors.append('object %s already exists' % path)
+                continue
+            try:
+                created[path] = self._create_object(path, interface, properties, methods)
+            except (dbus.exceptions.DBusException, SyntaxError, ValueError, KeyError, TypeError) as e:
+                errors.append(str(e) or e.__class__.__name__)
+                continue
+            errors.append('')
+
+        objects.update(created)
+        parents = set(path.rsplit('/', 1)[0] or '/' for path in created)
+        for parent in parents:
+            obj = objects.get(parent)
+            if obj is not None:
+                obj._invalidate_introspection()
+            _invalidate_ancestors(parent)
+
+        if emit_signals:
+            for (path, obj) in created.items():
+                manager = _object_manager(path)
+                if manager:
+                    manager.InterfacesAdded(dbus.ObjectPath(path), obj.props)
+
+        return errors
+
+    def _create_object(self, path, interface, properties, methods):
+        '''Create and export a DBusMockObject, without registering it'''
+
         obj = DBusMockObject(self.bus_name,
                              path,
                              interface,
                              properties)
-        obj.AddMethods(interface, methods)
-
-        objects[path] = obj
+        try:
+            obj.AddMethods(interface, methods)
+        except Exception:
+            obj.remove_from_connection()
+            raise
+        return obj
 
     @dbus.service.method(MOCK_IFACE,
                          in_signature='s',
@@ -185,11 +1606,18 @@ class DBusMockObject(dbus.service.Object):
         '''Remove a D-Bus object from the mock'''
 
         try:
-            del objects[path]
+            obj = objects.pop(path)
         except KeyError:
             raise dbus.exceptions.DBusException(
                 'org.freedesktop.DBus.Mock.NameError',
                 'object %s does not exist' % path)
+        obj._stop_sources()
+        obj.remove_from_connection()
+        _invalidate_ancestors(path)
+
+        manager = _object_manager(path)
+        if manager:
+            manager.InterfacesRemoved(dbus.ObjectPath(path), list(obj.props.keys()))
 
     @dbus.service.method(MOCK_IFACE,
                          in_signature='sssss',
@@ -221,9 +1649,32 @@ class DBusMockObject(dbus.service.Object):
 
               When specifying '', the method will not do anything (except
               logging) and return None.
+
+              The code gets compiled once when adding the method, so that
+              syntax errors are reported here and not on the first call.
+
+              When calling this from Python (e. g. in templates), code can
+              also be a function. It gets called with the mock object and the
+              method arguments, and its return value is the method's return
+              value.
         '''
         if not interface:
             interface = self.interface
+
+        # compile the snippet only once; this also reports syntax errors to the
+        # caller of AddMethod() instead of the first caller of the method
+        if callable(code):
+            code_object = code
+        elif code:
+            code_object = compile(code, '<%s.%s>' % (interface, name), 'exec')
+        else:
+            code_object = None
+
+        self._add_method(interface, name, in_sig, out_sig, code, code_object)
+
+    def _add_method(self, interface, name, in_sig, out_sig, code, code_object):
+        '''Add a method with already compiled code, see AddMethod()'''
+
         n_args = len(dbus.Signature(in_sig))
 
         # we need to have separate methods for dbus-python, so clone
@@ -240,10 +1691,15 @@ class DBusMockObject(dbus.service.Object):
         dbus_method.__name__ = str(name)
         dbus_method._dbus_in_signature = in_sig
         dbus_method._dbus_args = ['arg%i' % i for i in range(1, n_args + 1)]
+        # always reply through callbacks, so that methods can defer the reply
+        # (see defer_reply())
+        dbus_method._dbus_async_callbacks = ('_dbusmock_reply', '_dbusmock_error')
 
-        setattr(self.__class__, name, dbus_method)
+        setattr(self._object_class(), name, dbus_method)
 
-        self.methods.setdefault(interface, {})[str(name)] = (in_sig, out_sig, code, dbus_method)
+        self.methods.setdefault(interface, {})[str(name)] = (in_sig, out_sig, code, dbus_method, code_object,
+                                                             len(dbus.Signature(out_sig)))
+        self._invalidate_introspection()
 
     @dbus.service.method(MOCK_IFACE,
                          in_signature='sa(ssss)',
@@ -272,17 +1728,7 @@ class DBusMockObject(dbus.service.Object):
         name: Property name.
         value: Property value.
         '''
-        if not interface:
-            interface = self.interface
-        try:
-            self.props[interface][name]
-            raise dbus.exceptions.DBusException(
-                self.interface + '.PropertyExists',
-                'property %s already exists' % name)
-        except KeyError:
-            # this is what we expect
-            pass
-        self.props.setdefault(interface, {})[name] = value
+        self._add_properties(interface, {name: value})
 
     @dbus.service.method(MOCK_IFACE,
                          in_signature='sa{sv}',
@@ -295,8 +1741,72 @@ class DBusMockObject(dbus.service.Object):
                    interface (as specified on construction).
         properties: A property_name (string) → value map
         '''
-        for k, v in properties.items():
-            self.AddProperty(interface, k, v)
+        self._add_properties(interface, properties)
+
+    def _add_properties(self, interface, properties):
+        '''Add properties, see AddProperties()
+
+        If this adds a new interface to an object below an object manager,
+        this announces it with an InterfacesAdded signal.
+        '''
+        if not interface:
+            interface = self.interface
+        for name in properties:
+            if name in self.props.get(interface, {}):
+                raise dbus.exceptions.DBusException(
+                    self.interface + '.PropertyExists',
+                    'property %s already exists' % name)
+        new_interface = interface not in self.props
+        self.props.setdefault(interface, {}).update(properties)
+        self._invalidate_introspection()
+
+        if new_interface and objects.get(self.path) is self:
+            manager = _object_manager(self.path)
+            if manager:
+                manager.InterfacesAdded(dbus.ObjectPath(self.path), {interface: self.props[interface]})
+
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='a{sa{sa{sv}}}',
+                         out_signature='')
+    def UpdateProperties(self, changes):
+        '''Change properties of several objects at once
+
+        changes: An object path → interface → property_name → value map. For
+                 convenience you can specify '' as interface for the object's
+                 main interface.
+
+        All properties must already exist. If any object, interface, or
+        property does not exist, nothing gets changed. Like Set(), this emits
+        PropertiesChanged signals, at most one per object and interface.
+        '''
+        # check everything first, so that we do not apply partial changes
+        updates = []
+        for (path, interfaces) in changes.items():
+            try:
+                obj = objects[path]
+            except KeyError:
+                raise dbus.exceptions.DBusException(
+                    'object %s does not exist' % path,
+                    name=MOCK_IFACE + '.NameError')
+            for (interface, props) in interfaces.items():
+                interface = interface or obj.interface
+                iface_props = obj.props.get(interface)
+                if iface_props is None:
+                    raise dbus.exceptions.DBusException(
+                        'object %s has no interface %s' % (path, interface),
+                        name=MOCK_IFACE + '.NameError')
+                for name in props:
+                    if name not in iface_props:
+                        raise dbus.exceptions.DBusException(
+                            'object %s has no property %s.%s' % (path, interface, name),
+                            name=MOCK_IFACE + '.NameError')
+                updates.append((obj, interface, iface_props, props))
+
+        for (obj, interface, iface_props, props) in updates:
+            iface_props.update(props)
+            if obj.properties_changed:
+                for (name, value) in props.items():
+                    obj._queue_property_changed(interface, name, value)
 
     @dbus.service.method(MOCK_IFACE,
                          in_signature='sa{sv}',
@@ -325,16 +1835,250 @@ class DBusMockObject(dbus.service.Object):
         except ImportError as e:
             raise dbus.exceptions.DBusException('Cannot add template %s: %s' % (template, str(e)))
 
+        if parameters is None:
+            parameters = {}
+
+        self._load_template(module, parameters)
+
+    def _load_template(self, module, parameters):
+        self._add_template_methods(module)
+        module.load(self, parameters)
+        self._templates.append((module, parameters))
+        self._invalidate_introspection()
+
+    def _add_template_methods(self, module):
         # pick out all D-BUS service methods and add them to our interface
         for symbol in dir(module):
             fn = getattr(module, symbol)
             if '_dbus_interface' in dir(fn):
-                setattr(self.__class__, symbol, fn)
+                setattr(self._object_class(), symbol, fn)
 
-        if parameters is None:
-            parameters = {}
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='b',
+                         out_signature='')
+    def Reset(self, reapply_templates):
+        '''Reset the mock to its state after startup.
+
+        This removes all objects except this one, and all methods, properties,
+        and template state of this object; it clears the call log, stops
+        signal streams, and drops the settings of SetLatency(),
+        SetMethodThreaded(), SetMethodCalledMode(), and
+        SetPropertiesChangedPolicy(). Settings of the whole mock process, such
+        as the log level, are kept.
+
+        Call this on the main object of the mock, so that one mock process can
+        be used for many tests instead of starting a new one for each.
+
+        reapply_templates: If True, load the templates which were loaded
+                           before (with -t or AddTemplate()) again, with the
+                           same parameters, and the objects of the state file
+                           from the --state option. Otherwise the object ends
+                           up without a template and without the contents of
+                           the state file.
+        '''
+        for path in list(objects):
+            if objects[path] is not self:
+                obj = objects.pop(path)
+                obj._stop_sources()
+                obj.remove_from_connection()
+
+        self._stop_sources()
+
+        # drop methods and template functions from the private class, and
+        # attributes which templates added
+        for cls in self.__class__.__mro__:
+            if '_dbusmock_private_class' not in cls.__dict__:
+                self.__class__ = cls
+                break
+        for attr in set(self.__dict__) - self._base_attributes:
+            delattr(self, attr)
+
+        self.call_log.clear()
+        self.call_log.set_capacity(call_log_capacity)
+        self._init_state(dict(self._initial_props))
+
+        templates = self._templates
+        self._templates = []
+        if reapply_templates:
+            if self._startup_state is not None:
+                self._apply_state(self._startup_state, 'startup state')
+            # templates which were added after startup
+            for (module, parameters) in templates:
+                if module not in [m for (m, p) in self._templates]:
+                    self._load_template(module, parameters)
 
-        module.load(self, parameters)
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='s',
+                         out_signature='')
+    def SaveSnapshot(self, name):
+        '''Save the state of all mock objects under a name.
+
+        This covers all objects of the mock (not just this one), with their
+        properties, methods, settings, and template state. It does not include
+        the call logs. An existing snapshot with the same name gets replaced.
+
+        Values are shared between the snapshot and the objects where
+        possible, so that saving and restoring is much cheaper than setting up
+        the objects again; only the containers around them get copied.
+        '''
+        snapshots[name] = Snapshot()
+
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='s',
+                         out_signature='')
+    def RestoreSnapshot(self, name):
+        '''Restore the state of all mock objects from a snapshot.
+
+        Objects which were added after SaveSnapshot() get removed, and removed
+        ones come back. This does not emit any signals. The snapshot is kept,
+        so it can be restored any number of times.
+        '''
+        try:
+            snapshot = snapshots[name]
+        except KeyError:
+            raise dbus.exceptions.DBusException(
+                'no snapshot "%s"' % name,
+                name=MOCK_IFACE + '.NameError')
+        snapshot.restore()
+
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='s',
+                         out_signature='')
+    def RemoveSnapshot(self, name):
+        '''Forget a snapshot.'''
+
+        try:
+            del snapshots[name]
+        except KeyError:
+            raise dbus.exceptions.DBusException(
+                'no snapshot "%s"' % name,
+                name=MOCK_IFACE + '.NameError')
+
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='',
+                         out_signature='as')
+    def ListSnapshots(self):
+        '''Return the names of all snapshots.'''
+
+        return sorted(snapshots)
+
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='s',
+                         out_signature='')
+    def SaveState(self, filename):
+        '''Write the state of all mock objects into a file.
+
+        The file contains all objects (not just this one) with their
+        interfaces, properties and their D-Bus types, methods, templates, and
+        the state that templates keep in the objects. It does not contain call
+        logs and settings. Load it with LoadState() or the --state option, to
+        quickly set up the same objects again.
+
+        Methods whose code is a Python function (e. g. from templates) are
+        saved by their module and name, so these must be importable when
+        loading the file. Local templates are saved with their file path, so
+        they must still exist then.
+        '''
+        try:
+            state = {'version': 1,
+                     'objects': [objects[path]._dump_state() for path in sorted(objects)]}
+        except (ValueError, TypeError) as e:
+            raise dbus.exceptions.DBusException(
+                'cannot save state: %s' % e,
+                name=MOCK_IFACE + '.InvalidArgs')
+
+        with open(filename, 'w') as f:
+            json.dump(state, f, separators=(',', ':'))
+
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='s',
+                         out_signature='')
+    def LoadState(self, filename):
+        '''Load mock objects from a file written by SaveState().
+
+        All objects get created in one go, without emitting any signals. The
+        state of the object with the same path as this one gets added to this
+        object; all other objects in the file must not exist yet. If the file
+        is invalid, no objects get created or changed.
+        '''
+        self._apply_state(self._read_state(filename), filename)
+
+    def load_startup_state(self, filename):
+        '''Load a state file when starting the mock (--state option)
+
+        This works like LoadState(), and Reset() loads the same state again
+        when it reapplies templates.
+        '''
+        self._startup_state = self._read_state(filename)
+        self._apply_state(self._startup_state, filename)
+
+    def _read_state(self, filename):
+        '''Read and check a state file for _apply_state()
+
+        Return a list of (entry, parsed state) pairs for the objects in it.
+        '''
+        try:
+            with open(filename) as f:
+                state = json.load(f)
+        except (IOError, ValueError) as e:
+            raise dbus.exceptions.DBusException(
+                'cannot read state file %s: %s' % (filename, e),
+                name=MOCK_IFACE + '.InvalidArgs')
+        if not isinstance(state, dict) or state.get('version') != 1:
+            raise dbus.exceptions.DBusException(
+                'unsupported state file %s' % filename,
+                name=MOCK_IFACE + '.InvalidArgs')
+
+        # parse and check everything first, so that an invalid file does not
+        # leave this object half-loaded
+        code_cache = {}
+        try:
+            entries = state.get('objects', [])
+            if not isinstance(entries, list):
+                raise ValueError('"objects" must be a list')
+            return [(entry, _parse_state(entry, code_cache)) for entry in entries]
+        except Exception as e:
+            raise dbus.exceptions.DBusException(
+                'invalid state file %s: %s' % (filename, str(e) or e.__class__.__name__),
+                name=MOCK_IFACE + '.InvalidArgs')
+
+    def _apply_state(self, parsed, filename):
+        '''Create the objects from _read_state() and load their state'''
+
+        for (entry, obj_state) in parsed:
+            if entry['path'] != self.path and entry['path'] in objects:
+                raise dbus.exceptions.DBusException(
+                    'object %s already exists' % entry['path'],
+                    name=MOCK_IFACE + '.NameError')
+
+        created = collections.OrderedDict()
+        own_state = None
+        try:
+            for (entry, obj_state) in parsed:
+                if entry['path'] == self.path:
+                    own_state = obj_state
+                    continue
+                obj = DBusMockObject(self.bus_name, entry['path'], entry['interface'], {},
+                                     is_object_manager=entry.get('object_manager', False))
+                created[obj.path] = obj
+                obj._load_state(obj_state)
+        except Exception as e:
+            for obj in created.values():
+                obj.remove_from_connection()
+            raise dbus.exceptions.DBusException(
+                'invalid state file %s: %s' % (filename, str(e) or e.__class__.__name__),
+                name=MOCK_IFACE + '.InvalidArgs')
+
+        if own_state:
+            self._load_state(own_state)
+
+        objects.update(created)
+        parents = set(path.rsplit('/', 1)[0] or '/' for path in created)
+        for parent in parents:
+            obj = objects.get(parent)
+            if obj is not None:
+                obj._invalidate_introspection()
+            _invalidate_ancestors(parent)
 
     @dbus.service.method(MOCK_IFACE,
                          in_signature='sssav',
@@ -355,22 +2099,91 @@ class DBusMockObject(dbus.service.Object):
         if not interface:
             interface = self.interface
 
-        # convert types of arguments according to signature, using
-        # MethodCallMessage.append(); this will also provide type/length
-        # checks, except for the case of an empty signature
-        if signature == '' and len(args) > 0:
-            raise TypeError('Fewer items found in D-Bus signature than in Python arguments')
-        m = dbus.connection.MethodCallMessage('a.b', '/a', 'a.b', 'a')
-        m.append(signature=signature, *args)
-        args = m.get_args_list()
+        # convert types of arguments according to signature; this will also
+        # provide type/length checks
+        args = _convert_args(signature, args)
 
-        fn = lambda self, *args: self.log('emit %s.%s%s' % (interface, name, self.format_args(args)))
-        fn.__name__ = str(name)
-        dbus_fn = dbus.service.signal(interface)(fn)
-        dbus_fn._dbus_signature = signature
-        dbus_fn._dbus_args = ['arg%i' % i for i in range(1, len(args) + 1)]
+        self._signal_emitter(interface, name, signature, len(args))(self, *args)
 
-        dbus_fn(self, *args)
+    def _signal_emitter(self, interface, name, signature, n_args):
+        '''Return the cached signal function for EmitSignal()'''
+
+        key = (interface, name, signature)
+        try:
+            return self._signal_emitters[key]
+        except KeyError:
+            dbus_fn = self._signal_emitters[key] = _make_signal_emitter(interface, name, signature, n_args)
+            return dbus_fn
+
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='sssaavduu',
+                         out_signature='u')
+    def StartSignalStream(self, interface, name, signature, arg_sets, rate, count, duration):
+        '''Emit a signal periodically from the mock.
+
+        This is useful for load testing signal handling of clients, without
+        the overhead of an EmitSignal() call for every signal.
+
+        interface, name, signature: see EmitSignal()
+        arg_sets: array of signal argument lists; the signals rotate through
+                  them, so give just one to always emit the same arguments
+        rate: signals per second
+        count: number of signals after which the stream stops (0: unlimited)
+        duration: time in seconds after which the stream stops (0: unlimited)
+
+        If both count and duration are 0, the stream runs until
+        StopSignalStream() is called. Return the ID of the stream, for
+        StopSignalStream() and GetSignalStreamInfo().
+        '''
+        if not interface:
+            interface = self.interface
+        if rate <= 0 or not arg_sets:
+            raise dbus.exceptions.DBusException(
+                'rate must be positive, and arg_sets must not be empty',
+                name=MOCK_IFACE + '.InvalidArgs')
+
+        arg_sets = [_convert_args(signature, args) for args in arg_sets]
+        dbus_fn = self._signal_emitter(interface, name, signature, len(arg_sets[0]))
+        stream_id = next(self._signal_stream_ids)
+        self._signal_streams[stream_id] = SignalStream(lambda args: dbus_fn(self, *args),
+                                                       arg_sets, rate, count, duration)
+        return stream_id
+
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='u',
+                         out_signature='a{sv}')
+    def StopSignalStream(self, stream_id):
+        '''Stop and forget a signal stream.
+
+        Return its final statistics, see GetSignalStreamInfo().
+        '''
+        try:
+            stream = self._signal_streams.pop(stream_id)
+        except KeyError:
+            raise dbus.exceptions.DBusException(
+                'no signal stream %i' % stream_id,
+                name=MOCK_IFACE + '.NameError')
+        stream.stop()
+        return stream.info()
+
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='u',
+                         out_signature='a{sv}')
+    def GetSignalStreamInfo(self, stream_id):
+        '''Return statistics of a signal stream.
+
+        This is a dictionary with "running" (whether it is still emitting),
+        "emitted" (number of signals so far), "elapsed" (seconds since the
+        start, or until the end), "rate" (achieved signals per second), and
+        "lag" and "max_lag" (current and maximum time in seconds by which the
+        emitted signals fell behind the requested rate).
+        '''
+        try:
+            return self._signal_streams[stream_id].info()
+        except KeyError:
+            raise dbus.exceptions.DBusException(
+                'no signal stream %i' % stream_id,
+                name=MOCK_IFACE + '.NameError')
 
     @dbus.service.method(MOCK_IFACE,
                          in_signature='',
@@ -380,7 +2193,27 @@ class DBusMockObject(dbus.service.Object):
 
         Return a list of (timestamp, method_name, args_list) tuples.
         '''
-        return self.call_log
+        return [(e.timestamp, e.method, e.args) for e in self.call_log]
+
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='tu',
+                         out_signature='a(ttsav)')
+    def GetCallsSince(self, seq, max_count):
+        '''List the logged calls after a given sequence number.
+
+        Every logged call gets a sequence number which increases monotonically
+        for the life time of the mock (also across ClearCalls()), starting with
+        1. Pass 0 to get the calls from the beginning, or the sequence number
+        of the last call that you already received to only get newer ones.
+
+        max_count: Maximum number of calls to return (oldest first); 0 means
+                   unlimited. Use this for paging through big logs.
+
+        Return a list of (sequence_number, timestamp, method_name, args_list)
+        tuples.
+        '''
+        return [(e.seq, e.timestamp, e.method, e.args)
+                for e in self.call_log.entries_since(seq, max_count)]
 
     @dbus.service.method(MOCK_IFACE,
                          in_signature='s',
@@ -390,7 +2223,41 @@ class DBusMockObject(dbus.service.Object):
 
         Return a list of (timestamp, args_list) tuples.
         '''
-        return [(row[0], row[2]) for row in self.call_log if row[1] == method]
+        return [(e.timestamp, e.args) for e in self.call_log.method_entries(method)]
+
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='s',
+                         out_signature='u')
+    def GetMethodCallCount(self, method):
+        '''Return the number of logged calls of a particular method.'''
+
+        return self.call_log.method_count(method)
+
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='s',
+                         out_signature='a(tsdd)')
+    def GetCallLatencies(self, method):
+        '''List the reply latencies of logged calls.
+
+        method: Name of the method, or '' for all calls
+
+        Return a list of (sequence number, method name, injected latency,
+        actual latency) tuples, with latencies in seconds. The actual latency
+        is the time from receiving the call until sending the reply, or -1 if
+        the call was not answered yet or was not a D-Bus call.
+        See SetLatency().
+        '''
+        if method:
+            entries = self.call_log.method_entries(method)
+        else:
+            entries = self.call_log
+        result = []
+        for e in entries:
+            if e.reply_latency is None:
+                result.append((e.seq, e.method, e.latency, -1.0))
+            else:
+                result.append((e.seq, e.method, e.latency, e.reply_latency))
+        return result
 
     @dbus.service.method(MOCK_IFACE,
                          in_signature='',
@@ -398,90 +2265,507 @@ class DBusMockObject(dbus.service.Object):
     def ClearCalls(self):
         '''Empty the log of mock call signatures.'''
 
-        self.call_log = []
+        self.call_log.clear()
+
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='u',
+                         out_signature='')
+    def SetCallLogCapacity(self, capacity):
+        '''Set the maximum number of logged calls of this object.
+
+        When the call log is full, the oldest calls get dropped. 0 means
+        unlimited, which is the default unless the mock was started with
+        --call-log-capacity. If the log currently has more entries than
+        capacity, the oldest ones get dropped immediately.
+        '''
+        self.call_log.set_capacity(capacity)
+
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='',
+                         out_signature='a{sv}')
+    def GetCallLogInfo(self):
+        '''Get information about the call log.
+
+        Return a map with the keys "capacity" (maximum number of entries, 0 for
+        unlimited), "size" (current number of entries), "dropped" (number of
+        entries which were dropped because the log was full since the last call
+        to ClearCalls()), and "last_seq" (sequence number of the most recent
+        call, see GetCallsSince()).
+        '''
+        return {'capacity': dbus.UInt32(self.call_log.capacity),
+                'size': dbus.UInt32(len(self.call_log)),
+                'dropped': dbus.UInt64(self.call_log.dropped),
+                'last_seq': dbus.UInt64(self.call_log.last_seq)}
+
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='s',
+                         out_signature='')
+    def SetLogLevel(self, level):
+        '''Set the log level of the whole mock.
+
+        level: "off" (do not log calls and signals at all), "calls" (only log
+               method and signal names), "args" (also log arguments, but
+               abbreviate arrays and dictionaries with more than 1000
+               elements; this is the default), or "full" (log complete
+               arguments)
+        '''
+        global log_level
+
+        try:
+            log_level = log_levels[level]
+        except KeyError:
+            raise dbus.exceptions.DBusException(
+                'invalid log level "%s", must be one of %s' % (level, ', '.join(sorted(log_levels))),
+                name=MOCK_IFACE + '.InvalidArgs')
+
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='',
+                         out_signature='')
+    def FlushLog(self):
+        '''Write out all pending log messages.
+
+        This is only necessary if the mock runs with --buffered-log, and you
+        want to read the log while the mock is running.
+        '''
+        flush_logs()
+
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='su',
+                         out_signature='')
+    def SetMethodCalledMode(self, mode, window):
+        '''Configure the MethodCalled signal of this object.
+
+        mode: "signal" (emit a MethodCalled signal for every call; this is the
+              default), "aggregate" (emit one MethodsCalled signal with all
+              calls since the last one), or "off" (emit neither)
+        window: In "aggregate" mode, the time in milliseconds for collecting
+                calls into one MethodsCalled signal; with 0, the signal gets
+                emitted as soon as the main loop is idle, i. e. it contains
+                all calls which were handled in one main loop iteration.
+        '''
+        if mode not in method_called_modes:
+            raise dbus.exceptions.DBusException(
+                'invalid mode "%s", must be one of %s' % (mode, ', '.join(method_called_modes)),
+                name=MOCK_IFACE + '.InvalidArgs')
+
+        # deliver pending calls with the old settings
+        if self._method_called_source:
+            GLib.source_remove(self._method_called_source)
+            self._emit_methods_called()
+
+        self.method_called_mode = mode
+        self.method_called_window = window
+
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='ssb',
+                         out_signature='')
+    def SetMethodThreaded(self, interface, name, threaded):
+        '''Run a method in a worker thread.
+
+        interface: D-Bus interface of the method; for convenience you can
+                   specify '' here for the object's main interface.
+        name: Name of the method
+        threaded: Whether to run the method's code in the worker pool
+
+        Use this for methods which take a lot of time, so that they do not
+        block the calls of other methods. The number of worker threads is
+        limited (see --worker-threads); further calls wait in a queue. The
+        reply gets sent from the main loop when the code finishes.
+
+        The method code must not access the mock's state (properties, other
+        objects, signals) directly, but through self.call_in_main_loop().
+
+        This only makes methods run in parallel if their code releases the
+        Python GIL, e. g. by sleeping, waiting for I/O or subprocesses, or in C
+        extensions. Pure Python computations still take turns with the main
+        loop: other calls get answered in the meantime, but they are not any
+        faster.
+        '''
+        key = (interface or self.interface, name)
+        if key[1] not in self.methods.get(key[0], {}):
+            raise dbus.exceptions.DBusException(
+                'no method %s.%s' % key,
+                name=MOCK_IFACE + '.NameError')
+        if threaded:
+            self.threaded_methods.add(key)
+        else:
+            self.threaded_methods.discard(key)
+
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='',
+                         out_signature='a{sv}')
+    def GetWorkerPoolInfo(self):
+        '''Return statistics of the worker pool for threaded methods.
+
+        This is a dictionary with "threads" (maximum number of worker threads),
+        "queued" (calls waiting for a free thread), "running" (calls being
+        executed), "completed", and "max_queued" (largest queue depth so far).
+        '''
+        return get_worker_pool().info()
+
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='sssad',
+                         out_signature='')
+    def SetLatency(self, interface, name, model, params):
+        '''Delay the replies of a method, or of all methods of this object.
+
+        interface: D-Bus interface of the method; for convenience you can
+                   specify '' here for the object's main interface.
+        name: Name of the method, or '' for the default of all methods of this
+              object which do not have their own latency.
+        model: How to pick the delay of each call:
+               "none": reply immediately (params: none)
+               "fixed": always the same delay (params: delay)
+               "uniform": uniformly distributed (params: minimum, maximum)
+               "normal": normal distribution (params: mean, standard deviation)
+               "exponential": exponential distribution (params: mean)
+        params: Parameters of the model, in milliseconds
+
+        The mock keeps handling other calls while replies are delayed, so
+        concurrent calls overlap. Delays are random unless you call
+        SeedLatency() to make them reproducible. The injected and actual
+        latency of each call get recorded, see GetCallLatencies().
+        '''
+        if model not in latency_models or len(params) != latency_models[model] or \
+                any(p < 0 for p in params):
+            raise dbus.exceptions.DBusException(
+                'invalid latency model "%s" with parameters %s; models: %s' % (
+                    model, list(params), ', '.join(sorted(latency_models))),
+                name=MOCK_IFACE + '.InvalidArgs')
+
+        setting = (str(model), [float(p) for p in params])
+        if name:
+            # "none" gets stored as well, as it overrides the default
+            self.latency[(interface or self.interface, name)] = setting
+        elif model == 'none':
+            self.latency_default = None
+        else:
+            self.latency_default = setting
+
+    @dbus.service.method(MOCK_IFACE,
+                         in_signature='t',
+                         out_signature='')
+    def SeedLatency(self, seed):
+        '''Seed the random generator for SetLatency() delays.
+
+        This makes the delays of a test run reproducible.
+        '''
+        self.latency_random.seed(seed)
 
     @dbus.service.signal(MOCK_IFACE, signature='sav')
     def MethodCalled(self, name, args):
         pass
 
+    @dbus.service.signal(MOCK_IFACE, signature='a(sav)')
+    def MethodsCalled(self, calls):
+        pass
+
+    def _queue_method_called(self, name, args):
+        '''Queue a method call for the next MethodsCalled signal'''
+
+        self._method_calls.append((name, args))
+        if not self._method_called_source:
+            if self.method_called_window:
+                self._method_called_source = GLib.timeout_add(
+                    self.method_called_window, self._emit_methods_called)
+            else:
+                self._method_called_source = GLib.idle_add(self._emit_methods_called)
+
+    def _emit_methods_called(self):
+        calls = self._method_calls
+        self._method_calls = []
+        self._method_called_source = None
+        if calls:
+            self.MethodsCalled(calls)
+        return False
+
     def mock_method(self, interface, dbus_method, in_signature, *args, **kwargs):
         '''Master mock method.
 
-        This gets "instantiated" in AddMethod(). Execute the code snippet of
-        the method and return the "ret" variable if it was set.
+        This gets "instantiated" in AddMethod(). Call the method's function, or
+        execute its (precompiled) code snippet and return the "ret" variable if
+        it was set.
         '''
         #print('mock_method', dbus_method, self, in_signature, args, kwargs, file=sys.stderr)
+        start = time.time()
+
+        # convert types of arguments according to signature; this will also
+        # provide type/length checks, and is a no-op for arguments which
+        # dbus-python already demarshalled with the right types
+        args = _convert_args(in_signature, args)
+
+        if log_level:
+            self.log_call(dbus_method, args)
+        entry = self.call_log.append(str(dbus_method), args)
+        if self.method_called_mode == 'signal':
+            self.MethodCalled(dbus_method, args)
+        elif self.method_called_mode == 'aggregate':
+            self._queue_method_called(dbus_method, args)
+
+        # set when called over D-Bus, not when called directly from Python
+        reply_cb = kwargs.pop('_dbusmock_reply', None)
+        error_cb = kwargs.pop('_dbusmock_error', None)
+
+        if reply_cb is not None:
+            model = self.latency.get((interface, dbus_method), self.latency_default)
+            if model:
+                entry.latency = _sample_latency(self.latency_random, *model)
+            reply_cb = _timed_callback(entry, start, entry.latency, reply_cb, error_cb)
+            error_cb = _timed_callback(entry, start, entry.latency, error_cb)
+
+        method = self.methods[interface][dbus_method]
+        code = method[4]
+        reply_args = lambda ret: _reply_args(dbus_method, method[1], method[5], ret)
+        run = lambda: self._run_method_code(code, interface, dbus_method, in_signature, args, kwargs)
+
+        if reply_cb is None:
+            return run()
+
+        def finish(success, ret):
+            if success and isinstance(ret, DeferredReply):
+                ret._bind(reply_args, reply_cb, error_cb)
+                return
+            if success:
+                # this might run in a main loop callback (for threaded
+                # methods), so send errors in the reply to the caller
+                try:
+                    reply_cb(*reply_args(ret))
+                    return
+                except Exception as e:
+                    ret = e
+            error_cb(ret)
+
+        if (interface, dbus_method) in self.threaded_methods:
+            get_worker_pool().submit(run, finish)
+            return
 
-        # convert types of arguments according to signature, using
-        # MethodCallMessage.append(); this will also provide type/length
-        # checks, except for the case of an empty signature
-        if in_signature == '' and len(args) > 0:
-            raise TypeError('Fewer items found in D-Bus signature than in Python arguments')
-        m = dbus.connection.MethodCallMessage('a.b', '/a', 'a.b', 'a')
-        m.append(signature=in_signature, *args)
-        args = m.get_args_list()
+        try:
+            ret = run()
+        except Exception as e:
+            finish(False, e)
+            return
+        finish(True, ret)
 
-        self.log(dbus_method + self.format_args(args))
-        self.call_log.append((int(time.time()), str(dbus_method), args))
-        self.MethodCalled(dbus_method, args)
+    def _run_method_code(self, code, interface, dbus_method, in_signature, args, kwargs):
+        '''Run the function or code snippet of a mock method
 
-        code = self.methods[interface][dbus_method][2]
+        Return the method's return value.
+        '''
+        if callable(code):
+            return code(self, *args)
         if code:
-            loc = locals().copy()
+            loc = {'self': self, 'interface': interface, 'dbus_method': dbus_method,
+                   'in_signature': in_signature, 'args': args, 'kwargs': kwargs}
             exec(code, globals(), loc)
-            if 'ret' in loc:
-                return loc['ret']
+            return loc.get('ret')
+
+    def defer_reply(self):
+        '''Answer the current method call later.
+
+        Mock methods can return the DeferredReply handle that this returns
+        (in code snippets: "ret = self.defer_reply()"), and call its reply()
+        or error() method later, e. g. from a GLib timeout. The mock keeps
+        handling other calls in the meantime.
+        '''
+        return DeferredReply()
+
+    def call_in_main_loop(self, fn, *args):
+        '''Call fn(*args) in the main loop and return its result.
+
+        Code of methods which run in a worker thread (see SetMethodThreaded())
+        must use this for everything that reads or changes the mock's state,
+        such as properties, other objects, or emitting signals. This blocks
+        the worker thread until the main loop ran fn. In the main loop, fn just
+        gets called directly.
+        '''
+        if threading.current_thread() is _main_thread:
+            return fn(*args)
+
+        done = threading.Event()
+        result = []
+
+        def run():
+            try:
+                result.append((True, fn(*args)))
+            except Exception as e:
+                result.append((False, e))
+            done.set()
+            return False
+
+        GLib.idle_add(run)
+        done.wait()
+        (success, value) = result[0]
+        if not success:
+            raise value
+        return value
 
     def format_args(self, args):
-        '''Format a D-BUS argument tuple into an appropriate logging string.'''
-
-        def format_arg(a):
-            if isinstance(a, dbus.Boolean):
-                return str(bool(a))
-            if isinstance(a, dbus.Byte):
-                return str(int(a))
-            if isinstance(a, int) or isinstance(a, long):
-                return str(a)
-            if isinstance(a, str) or isinstance(a, unicode):
-                return '"' + str(a) + '"'
-            if isinstance(a, list):
-                return '[' + ', '.join([format_arg(x) for x in a]) + ']'
-            if isinstance(a, dict):
-                fmta = '{'
-                first = True
-                for k, v in a.items():
-                    if first:
-                        first = False
-                    else:
-                        fmta += ', '
-                    fmta += format_arg(k) + ': ' + format_arg(v)
-                return fmta + '}'
-
-            # fallback
-            return repr(a)
-
-        s = ''
-        for a in args:
-            if s:
-                s += ' '
-            s += format_arg(a)
-        if s:
-            s = ' ' + s
-        return s
+        '''Format a D-BUS argument tuple into an appropriate logging string.
+
+        Unless the log level is "full", arrays and dictionaries with more than
+        log_max_items elements get abbreviated.
+        '''
+        if not args:
+            return ''
+        if log_level >= LOG_FULL:
+            max_items = 0
+        else:
+            max_items = log_max_items
+        return ' ' + ' '.join([_format_arg(a, max_items) for a in args])
+
+    def log_call(self, name, args):
+        '''Log a method call or signal according to the current log level.
+
+        The arguments only get formatted if the log level needs them.
+        '''
+        if log_level == LOG_CALLS:
+            self.log(name)
+        elif log_level >= LOG_ARGS:
+            self.log(name + self.format_args(args))
 
     def log(self, msg):
         '''Log a message, prefixed with a timestamp.
 
         If a log file was specified in the constructor, it is written there,
-        otherwise it goes to stdout.
+        otherwise it goes to stdout. In buffered mode (--buffered-log), this
+        does not wait for the message to be written.
         '''
-        if self.logfile:
-            fd = self.logfile
-        else:
-            fd = sys.stdout
+        self.log_writer.write(msg)
 
-        fd.write('%.3f %s\n' % (time.time(), msg))
-        fd.flush()
+    def _object_class(self):
+        '''Return a class which only this object uses.
+
+        dbus-python looks up D-Bus methods on the class of an object. So that
+        objects do not share and overwrite each other's methods, dynamically
+        added methods go into a private subclass, which gets created on first
+        use.
+        '''
+        cls = self.__class__
+        if '_dbusmock_private_class' not in cls.__dict__:
+            name = '%s_%x' % (cls.__name__, id(self))
+            cls = type(name, (cls,), {'__module__': cls.__module__,
+                                      '_dbusmock_private_class': True})
+            # dbus-python registers every class in its class table; we do not
+            # need that for private classes (see Introspect()), so avoid
+            # growing it with every object
+            cls._dbus_class_table.pop(cls.__module__ + '.' + name, None)
+            self.__class__ = cls
+        return cls
+
+    def _stop_sources(self):
+        '''Stop the signal streams and pending signals of this object
+
+        This needs to happen when removing the object, as their main loop
+        sources would otherwise keep running.
+        '''
+        for stream in self._signal_streams.values():
+            stream.stop()
+        self._signal_streams.clear()
+        for source in (self._changed_props_source, self._method_called_source):
+            if source:
+                GLib.source_remove(source)
+        self._changed_props_source = None
+        self._changed_props = {}
+        self._method_called_source = None
+        self._method_calls = []
+
+    def _save_state(self):
+        '''Return a copy of the state of this object for a snapshot
+
+        This contains the properties and methods, the settings of the object,
+        the attributes added by templates, and the dynamically added D-Bus
+        methods on the private class.
+        '''
+        attrs = dict((name, _copy_state(value)) for (name, value) in self.__dict__.items()
+                     if name in self._snapshot_attributes or name not in self._base_attributes)
+        cls = self.__class__
+        if '_dbusmock_private_class' in cls.__dict__:
+            cls_attrs = dict((name, value) for (name, value) in cls.__dict__.items()
+                             if not name.startswith('__'))
+        else:
+            cls_attrs = None
+        return (attrs, cls, cls_attrs)
+
+    def _restore_state(self, state):
+        '''Restore the state from _save_state()'''
+
+        (attrs, cls, cls_attrs) = state
+        for name in set(self.__dict__) - self._base_attributes - set(attrs):
+            delattr(self, name)
+        for (name, value) in attrs.items():
+            setattr(self, name, _copy_state(value))
+
+        self.__class__ = cls
+        if cls_attrs is not None:
+            for name in [n for n in cls.__dict__ if not n.startswith('__') and n not in cls_attrs]:
+                delattr(cls, name)
+            for (name, value) in cls_attrs.items():
+                if cls.__dict__.get(name) is not value:
+                    setattr(cls, name, value)
+
+        self._invalidate_introspection()
+
+    def _dump_state(self):
+        '''Return the state of this object for a state file
+
+        This is a JSON compatible dictionary with the properties and methods,
+        the templates, and the attributes added by templates. Property and
+        attribute values carry their D-Bus signature.
+        '''
+        dump_variant = _get_json_dumper('v')
+        state = {
+            'path': self.path,
+            'interface': self.interface,
+            'properties': dict((iface, dict((name, dump_variant(value)) for (name, value) in props.items()))
+                               for (iface, props) in self.props.items()),
+            'methods': {},
+        }
+        for (iface, methods) in self.methods.items():
+            state['methods'][iface] = m = {}
+            for (name, (in_sig, out_sig, code, dbus_fn, code_object, n_out)) in methods.items():
+                if callable(code):
+                    code = {'function': _function_name(code)}
+                m[name] = [in_sig, out_sig, code]
+
+        if self._templates:
+            dump_params = _get_json_dumper('a{sv}')
+            state['templates'] = [[_template_name(module), dump_params(parameters)]
+                                  for (module, parameters) in self._templates]
+        attrs = dict((name, dump_variant(value)) for (name, value) in self.__dict__.items()
+                     if name not in self._base_attributes)
+        if attrs:
+            state['attributes'] = attrs
+        if self.is_object_manager:
+            state['object_manager'] = True
+        return state
+
+    def _load_state(self, state):
+        '''Add the state from _parse_state() to this object'''
+
+        (templates, props, methods, attrs) = state
+        for (module, parameters) in templates:
+            # e. g. loaded again by Reset()
+            if module in [m for (m, p) in self._templates]:
+                continue
+            self._add_template_methods(module)
+            self._templates.append((module, parameters))
+
+        # copy the values, as the state can be loaded again by Reset()
+        for (iface, iface_props) in props.items():
+            self.props.setdefault(iface, {}).update(_copy_state(iface_props))
+
+        for (iface, name, in_sig, out_sig, code, code_object) in methods:
+            self._add_method(iface, name, in_sig, out_sig, code, code_object)
+
+        for (name, value) in attrs.items():
+            setattr(self, name, _copy_state(value))
+
+        self._invalidate_introspection()
+
+    def _invalidate_introspection(self):
+        '''Drop the cached introspection XML of this object'''
+
+        self._introspection_xml.clear()
 
     @dbus.service.method(dbus.INTROSPECTABLE_IFACE,
                          in_signature='',
@@ -491,35 +2775,113 @@ class DBusMockObject(dbus.service.Object):
     def Introspect(self, object_path, connection):
         '''Return XML description of this object's interfaces, methods and signals.
 
-        This wraps dbus-python's Introspect() method to include the dynamic
-        methods and properties.
+        This replaces dbus-python's Introspect() method to include the dynamic
+        methods. The result is cached until methods, properties, or child
+        objects get added or removed.
         '''
-        # temporarily add our dynamic methods
-        cls = self.__class__.__module__ + '.' + self.__class__.__name__
-        orig_interfaces = self._dbus_class_table[cls]
+        try:
+            return self._introspection_xml[object_path]
+        except KeyError:
+            pass
+
+        # build the interface table from the one of the registered class and
+        # the dynamic methods in our private class
+        cls = self.__class__
+        base = cls
+        if '_dbusmock_private_class' in cls.__dict__:
+            base = cls.__bases__[0]
+        interfaces = {}
+        for (interface, funcs) in self._dbus_class_table[base.__module__ + '.' + base.__name__].items():
+            interfaces[interface] = funcs.copy()
+        if base is not cls:
+            for (name, fn) in cls.__dict__.items():
+                if hasattr(fn, '_dbus_interface'):
+                    interfaces.setdefault(fn._dbus_interface, {})[name] = fn
+
+        xml = [_dbus_bindings.DBUS_INTROSPECT_1_0_XML_DOCTYPE_DECL_NODE,
+               '<node name="%s">\n' % object_path]
+        for (interface, funcs) in interfaces.items():
+            xml.append('  <interface name="%s">\n' % interface)
+            for fn in funcs.values():
+                if getattr(fn, '_dbus_is_method', False):
+                    xml.append(cls._reflect_on_method(fn))
+                elif getattr(fn, '_dbus_is_signal', False):
+                    xml.append(cls._reflect_on_signal(fn))
+            xml.append('  </interface>\n')
+        for name in connection.list_exported_child_objects(object_path):
+            xml.append('  <node name="%s"/>\n' % name)
+        xml.append('</node>\n')
+
+        xml = ''.join(xml)
+        self._introspection_xml[object_path] = xml
+        return xml
 
-        mock_interfaces = orig_interfaces.copy()
-        for interface, methods in self.methods.items():
-            for method in methods:
-                mock_interfaces.setdefault(interface, {})[method] = self.methods[interface][method][3]
-        self._dbus_class_table[cls] = mock_interfaces
 
-        xml = super(self.__class__, self).Introspect(object_path, connection)
+def _object_manager(path):
+    '''Return the object manager responsible for path, or None'''
 
-        # restore original class table
-        self._dbus_class_table[cls] = orig_interfaces
+    while path != '/':
+        path = path.rsplit('/', 1)[0] or '/'
+        obj = objects.get(path)
+        if obj is not None and obj.is_object_manager:
+            return obj
+    return None
+
+
+#
+# org.freedesktop.DBus.ObjectManager API; this gets added to objects which are
+# created with is_object_manager=True
+#
+
+
+@dbus.service.method(OBJECT_MANAGER_IFACE,
+                     in_signature='', out_signature='a{oa{sa{sv}}}')
+def GetManagedObjects(self):
+    '''Standard D-Bus API for getting all objects below this one, with their properties'''
+
+    result = {}
+    for path in objects.descendants(self.path):
+        if path != self.path:
+            result[dbus.ObjectPath(path)] = objects[path].props
+    return result
+
+
+@dbus.service.signal(OBJECT_MANAGER_IFACE, signature='oa{sa{sv}}')
+def InterfacesAdded(self, path, interfaces):
+    '''Standard D-Bus signal for a new object below this one'''
+
+    if log_level:
+        self.log_call('emit %s.InterfacesAdded' % OBJECT_MANAGER_IFACE, (path,))
+
+
+@dbus.service.signal(OBJECT_MANAGER_IFACE, signature='oas')
+def InterfacesRemoved(self, path, interfaces):
+    '''Standard D-Bus signal for a removed object below this one'''
+
+    if log_level:
+        self.log_call('emit %s.InterfacesRemoved' % OBJECT_MANAGER_IFACE, (path, interfaces))
 
-        return xml
 
 #
 # Helper API for templates
 #
 
 
-def get_objects():
-    '''Return all existing object paths'''
+def get_objects(prefix=None):
+    '''Return all existing object paths
+
+    If prefix is given, only return the sorted paths of the objects at or below
+    that path.
+    '''
+    if prefix is None:
+        return objects.keys()
+    return objects.descendants(prefix.rstrip('/') or '/')
+
+
+def get_children(path):
+    '''Return sorted paths of the objects directly below path'''
 
-    return objects.keys()
+    return objects.children(path.rstrip('/') or '/')
 
 
 def get_object(path):
@@ -15,6 +15,8 @@ __email__ = 'hadess@hadess.net'
 __copyright__ = '(c) 2013 Red Hat Inc.'
 __license__ = 'LGPL 3+'
 
+from gi.repository import GLib
+
 BUS_NAME = 'org.gnome.ScreenSaver'
 MAIN_OBJ = '/org/gnome/ScreenSaver'
 MAIN_IFACE = 'org.gnome.ScreenSaver'
@@ -23,14 +25,36 @@ SYSTEM_BUS = False
 
 def load(mock, parameters):
     mock.AddMethods(MAIN_IFACE, [
-        ('GetActive', '', 'b', 'ret = self.is_active'),
+        ('GetActive', '', 'b', GetActive),
         ('GetActiveTime', '', 'u', 'ret = 1'),
-        ('SetActive', 'b', '', 'self.is_active = args[0]; self.EmitSignal('
-                               '"", "ActiveChanged", "b", [self.is_active])'),
-        ('Lock', '', '', 'time.sleep(1); self.SetActive(True)'),
+        ('SetActive', 'b', '', SetActive),
+        ('Lock', '', '', Lock),
         ('ShowMessage', 'sss', '', ''),
         ('SimulateUserActivity', '', '', ''),
     ])
 
     # default state
     mock.is_active = False
+
+
+def GetActive(self):
+    return self.is_active
+
+
+def SetActive(self, active):
+    self.is_active = active
+    self.EmitSignal('', 'ActiveChanged', 'b', [active])
+
+
+def Lock(self):
+    # locking takes a second; answer from a timeout, so that the mock keeps
+    # handling other calls in the meantime
+    reply = self.defer_reply()
+
+    def locked():
+        self.SetActive(True)
+        reply.reply()
+        return False
+
+    GLib.timeout_add(1000, locked)
+    return reply
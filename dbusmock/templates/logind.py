@@ -40,6 +40,7 @@ def load(mock, parameters):
         ('CanHibernate', '', 's', 'ret = %s' % parameters.get('CanHibernate', 'yes')),
         ('CanHybridSleep', '', 's', 'ret = %s' % parameters.get('CanHybridSleep', 'yes')),
 
+        ('ListSessions', '', 'a(susso)', ListSessions),
         ('GetSession', 's', 'o', 'ret = "/org/freedesktop/login1/session/" + args[0]'),
         ('ActivateSession', 's', '', ''),
         ('ActivateSessionOnSeat', 'ss', '', ''),
@@ -52,9 +53,10 @@ def load(mock, parameters):
         ('UnlockSessions', '', '', ''),
 
         ('GetSeat', 's', 'o', 'ret = "/org/freedesktop/login1/seat/" + args[0]'),
-        ('ListSeats', '', 'a(so)', 'ret = [(k.split("/")[-1], k) for k in objects.keys() if "/seat/" in k]'),
+        ('ListSeats', '', 'a(so)', ListSeats),
         ('TerminateSeat', 's', '', ''),
 
+        ('ListUsers', '', 'a(uso)', ListUsers),
         ('GetUser', 'u', 'o', 'ret = "/org/freedesktop/login1/user/%u" % args[0]'),
         ('KillUser', 'us', '', ''),
         ('TerminateUser', 'u', '', ''),
@@ -75,33 +77,31 @@ def load(mock, parameters):
 
 
 #
-# logind methods which are too big for squeezing into AddMethod()
+# logind methods, added with AddMethod() in load()
 #
 
-@dbus.service.method(MAIN_IFACE,
-                     in_signature='',
-                     out_signature='a(uso)')
+def ListSeats(self):
+    return [(k.split('/')[-1], k) for k in mockobject.get_children('/org/freedesktop/login1/seat')]
+
+
 def ListUsers(self):
     users = []
-    for k, obj in mockobject.objects.items():
-        if '/user/' in k:
-            uid = dbus.UInt32(int(k.split("/")[-1]))
-            users.append((uid, obj.Get('org.freedesktop.login1.User', 'Name'), k))
+    for k in mockobject.get_children('/org/freedesktop/login1/user'):
+        obj = mockobject.objects[k]
+        uid = dbus.UInt32(int(k.split("/")[-1]))
+        users.append((uid, obj.get_property('org.freedesktop.login1.User', 'Name'), k))
     return users
 
 
-@dbus.service.method(MAIN_IFACE,
-                     in_signature='',
-                     out_signature='a(susso)')
 def ListSessions(self):
     sessions = []
-    for k, obj in mockobject.objects.items():
-        if '/session/' in k:
-            session_id = k.split("/")[-1]
-            uid = obj.Get('org.freedesktop.login1.Session', 'User')[0]
-            username = obj.Get('org.freedesktop.login1.Session', 'Name')
-            seat = obj.Get('org.freedesktop.login1.Session', 'Seat')[0]
-            sessions.append((session_id, uid, username, seat, k))
+    for k in mockobject.get_children('/org/freedesktop/login1/session'):
+        obj = mockobject.objects[k]
+        session_id = k.split("/")[-1]
+        uid = obj.get_property('org.freedesktop.login1.Session', 'User')[0]
+        username = obj.get_property('org.freedesktop.login1.Session', 'Name')
+        seat = obj.get_property('org.freedesktop.login1.Session', 'Seat')[0]
+        sessions.append((session_id, uid, username, seat, k))
     return sessions
 
 #
@@ -243,15 +243,15 @@ def AddSession(self, session_id, seat, uid, username, active):
 
     # add session to seat
     obj_seat = mockobject.objects[seat_path]
-    cur_sessions = obj_seat.Get('org.freedesktop.login1.Seat', 'Sessions')
+    cur_sessions = obj_seat.get_property('org.freedesktop.login1.Seat', 'Sessions')
     cur_sessions.append((session_id, session_path))
-    obj_seat.Set('org.freedesktop.login1.Seat', 'Sessions', cur_sessions)
-    obj_seat.Set('org.freedesktop.login1.Seat', 'ActiveSession', (session_id, session_path))
+    obj_seat.set_property('org.freedesktop.login1.Seat', 'Sessions', cur_sessions)
+    obj_seat.set_property('org.freedesktop.login1.Seat', 'ActiveSession', (session_id, session_path))
 
     # add session to user
     obj_user = mockobject.objects[user_path]
-    cur_sessions = obj_user.Get('org.freedesktop.login1.User', 'Sessions')
+    cur_sessions = obj_user.get_property('org.freedesktop.login1.User', 'Sessions')
     cur_sessions.append((session_id, session_path))
-    obj_user.Set('org.freedesktop.login1.User', 'Sessions', cur_sessions)
+    obj_user.set_property('org.freedesktop.login1.User', 'Sessions', cur_sessions)
 
     return session_path
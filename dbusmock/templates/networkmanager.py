@@ -50,8 +50,7 @@ class DeviceState:
 
 def load(mock, parameters):
     mock.AddMethods(MAIN_IFACE, [
-        ('GetDevices', '', 'ao',
-         'ret = [k for k in objects.keys() if "/Devices" in k]'),
+        ('GetDevices', '', 'ao', GetDevices),
         ('GetPermissions', '', 'a{ss}', 'ret = {}')])
 
     mock.AddProperties('',
@@ -68,6 +67,18 @@ def load(mock, parameters):
                        })
 
 
+#
+# NetworkManager methods, added with AddMethod()
+#
+
+def GetDevices(self):
+    return dbusmock.get_children('/org/freedesktop/NetworkManager/Devices')
+
+
+def GetAccessPoints(self):
+    return self.access_points
+
+
 @dbus.service.method(MOCK_IFACE,
                      in_signature='ssi', out_signature='s')
 def AddEthernetDevice(self, device_name, iface_name, state):
@@ -130,8 +141,7 @@ def AddWiFiDevice(self, device_name, iface_name, state):
                        'WirelessCapabilities': dbus.UInt32(255, variant_level=1)
                    },
                    [
-                       ('GetAccessPoints', '', 'ao',
-                        'ret = self.access_points'),
+                       ('GetAccessPoints', '', 'ao', GetAccessPoints),
                    ])
 
     dev_obj = dbusmock.get_object(path)
@@ -32,7 +32,7 @@ def load(mock, parameters):
                    'CheckAuthorization',
                    '(sa{sv})sa{ss}us',
                    '(bba{ss})',
-                   '''ret = (args[1] in self.allowed or self.allow_unknown, False, {'test': 'test'})''')
+                   CheckAuthorization)
 
     mock.AddProperties(MAIN_IFACE,
                        dbus.Dictionary({
@@ -46,6 +46,10 @@ def load(mock, parameters):
     mock.allowed = []
 
 
+def CheckAuthorization(self, subject, action_id, details, flags, cancellation_id):
+    return (action_id in self.allowed or self.allow_unknown, False, {'test': 'test'})
+
+
 @dbus.service.method(MOCK_IFACE, in_signature='b', out_signature='')
 def AllowUnknown(self, default):
     '''Control whether unknown actions are allowed
@@ -20,6 +20,7 @@ __license__ = 'LGPL 3+'
 import dbus
 
 from dbusmock import MOCK_IFACE
+import dbusmock
 
 BUS_NAME = 'org.freedesktop.UPower'
 MAIN_OBJ = '/org/freedesktop/UPower'
@@ -32,7 +33,7 @@ def load(mock, parameters):
         ('Suspend', '', '', ''),
         ('SuspendAllowed', '', 'b', 'ret = %s' % parameters.get('SuspendAllowed', True)),
         ('HibernateAllowed', '', 'b', 'ret = %s' % parameters.get('HibernateAllowed', True)),
-        ('EnumerateDevices', '', 'ao', 'ret = [k for k in objects.keys() if "/devices" in k]'),
+        ('EnumerateDevices', '', 'ao', EnumerateDevices),
     ])
 
     mock.AddProperties(MAIN_IFACE,
@@ -49,6 +50,10 @@ def load(mock, parameters):
                        }, signature='sv'))
 
 
+def EnumerateDevices(self):
+    return dbusmock.get_children('/org/freedesktop/UPower/devices')
+
+
 @dbus.service.method(MOCK_IFACE,
                      in_signature='ss', out_signature='s')
 def AddAC(self, device_name, model_name):
@@ -217,6 +217,21 @@ class DBusTestCase(unittest.TestCase):
 
         return (daemon, obj)
 
+    @classmethod
+    def reset_server(klass, obj, reapply_templates=True):
+        '''Reset a spawned D-BUS mock to its state after startup
+
+        obj is the main dbus object of the mock, e. g. as returned by
+        spawn_server_template(). This removes all objects, methods, and
+        properties which tests added, and clears the call log; by default, the
+        templates get loaded again with their original parameters. See
+        dbusmock.DBusMockObject.Reset() for details.
+
+        This is a lot cheaper than starting a new mock, so you can spawn the
+        mock once in setUpClass() and call this in tearDown().
+        '''
+        obj.Reset(reapply_templates, dbus_interface=MOCK_IFACE)
+
 # Python 2 backwards compatibility
 if sys.version_info[0] < 3:
     import re
@@ -18,6 +18,7 @@ import subprocess
 import time
 
 import dbus
+import dbus.lowlevel
 import dbus.mainloop.glib
 
 import dbusmock
@@ -87,6 +88,21 @@ class TestAPI(dbusmock.DBusTestCase):
         with open(self.mock_log.name) as f:
             self.assertRegex(f.read(), '^[0-9.]+ Do "foo" 3$')
 
+    def test_ret_signature_mismatch(self):
+        '''return values which do not fit the number of out arguments'''
+
+        self.dbus_mock.AddMethod('', 'RetNoSig', '', '', 'ret = 5')
+        self.dbus_mock.AddMethod('', 'RetNoSeq', '', 'is', 'ret = 5')
+        self.dbus_mock.AddMethod('', 'RetSet', '', 'ii', 'ret = set([1])')
+        self.dbus_mock.AddMethod('', 'RetTwo', '', 'is', 'ret = [1, "a"]')
+        for name in ['RetNoSig', 'RetNoSeq', 'RetSet']:
+            try:
+                getattr(self.dbus_test, name)()
+                self.fail('%s() should raise an error' % name)
+            except dbus.exceptions.DBusException as e:
+                self.assertEqual(e.get_dbus_name(), 'org.freedesktop.DBus.Python.TypeError')
+        self.assertEqual(self.dbus_test.RetTwo(), (1, 'a'))
+
     def test_array_arg(self):
         '''array argument'''
 
@@ -120,6 +136,56 @@ assert args[2] == 5
         with open(self.mock_log.name) as f:
             self.assertRegex(f.read(), '^[0-9.]+ Do -1 {"foo": 42} 5$')
 
+    def test_struct_variant_arg(self):
+        '''struct and variant arguments'''
+
+        self.dbus_mock.AddMethod('', 'Do', '(sv)a{sv}', '',
+                                 '''assert len(args) == 2
+assert args[0] == ('foo', 42)
+assert type(args[0]) == dbus.Struct
+assert type(args[0][0]) == dbus.String
+assert type(args[0][1]) == dbus.Int32
+assert args[0][1].variant_level == 1
+assert args[1] == {'bar': 'baz'}
+assert type(args[1]) == dbus.Dictionary
+assert type(args[1]['bar']) == dbus.String
+assert args[1]['bar'].variant_level == 1
+''')
+        self.assertEqual(self.dbus_test.Do(('foo', 42), {'bar': 'baz'}), None)
+
+        # same conversion when calling the method directly from mock code
+        self.dbus_mock.AddMethod('', 'Indirect', '', '',
+                                 'self.Do(("foo", 42), {"bar": "baz"})')
+        self.assertEqual(self.dbus_test.Indirect(), None)
+
+    def test_log_levels(self):
+        '''log levels and abbreviation of big arguments'''
+
+        self.dbus_mock.AddMethod('', 'Do', 'sai', '', '')
+        self.dbus_mock.AddMethod('', 'Blob', 'ay', '', '')
+
+        self.dbus_test.Do('hello', [1, 2])
+        self.dbus_test.Do('big', list(range(2000)))
+        self.dbus_test.Blob(dbus.ByteArray(b'x' * 5000))
+        self.dbus_mock.SetLogLevel('calls')
+        self.dbus_test.Do('calls', [1])
+        self.dbus_mock.SetLogLevel('off')
+        self.dbus_test.Do('off', [1])
+        self.dbus_mock.SetLogLevel('full')
+        self.dbus_test.Do('full', list(range(1001)))
+
+        self.assertRaises(dbus.exceptions.DBusException,
+                          self.dbus_mock.SetLogLevel, 'verbose')
+
+        with open(self.mock_log.name) as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 5, lines)
+        self.assertRegex(lines[0], '^[0-9.]+ Do "hello" \[1, 2\]$')
+        self.assertRegex(lines[1], '^[0-9.]+ Do "big" \[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, \.\.\. \(2000 items\)\]$')
+        self.assertRegex(lines[2], '^[0-9.]+ Blob <5000 bytes>$')
+        self.assertRegex(lines[3], '^[0-9.]+ Do$')
+        self.assertRegex(lines[4], '^[0-9.]+ Do "full" \[0, 1, .*, 999, 1000\]$')
+
     def test_methods_on_other_interfaces(self):
         '''methods on other interfaces'''
 
@@ -166,6 +232,18 @@ assert args[2] == 5
         check('i', ['hello'], 'TypeError: an integer is required')
         check('s', [1], 'TypeError: Expected a string')
 
+    def test_method_syntax_error(self):
+        '''invalid method code is rejected when adding the method'''
+
+        try:
+            self.dbus_mock.AddMethod('', 'Do', '', 'i', 'ret = (')
+            self.fail('AddMethod() did not raise an error for invalid code')
+        except dbus.exceptions.DBusException as e:
+            self.assertTrue('SyntaxError' in str(e), e)
+
+        # method did not get added
+        self.assertRaises(dbus.exceptions.DBusException, self.dbus_test.Do)
+
     def test_add_object(self):
         '''add a new object'''
 
@@ -192,6 +270,93 @@ assert args[2] == 5
                        dbus_interface=dbusmock.MOCK_IFACE)
         self.assertEqual(dbus_sub.Do(), 'hello')
 
+    def test_methods_per_object(self):
+        '''methods do not leak to other objects'''
+
+        self.dbus_mock.AddObject('/obj1', 'org.freedesktop.Test.Sub', {},
+                                 [('Do', '', 's', 'ret = "obj1"')])
+        self.dbus_mock.AddObject('/obj2', 'org.freedesktop.Test.Sub', {},
+                                 [('Do', '', 's', 'ret = "obj2"'),
+                                  ('Only2', '', '', '')])
+        obj1 = dbus.Interface(self.dbus_con.get_object('org.freedesktop.Test', '/obj1'),
+                              'org.freedesktop.Test.Sub')
+        obj2 = dbus.Interface(self.dbus_con.get_object('org.freedesktop.Test', '/obj2'),
+                              'org.freedesktop.Test.Sub')
+
+        self.assertEqual(obj1.Do(), 'obj1')
+        self.assertEqual(obj2.Do(), 'obj2')
+        self.assertEqual(obj2.Only2(), None)
+        self.assertRaises(dbus.exceptions.DBusException, obj1.Only2)
+        self.assertRaises(dbus.exceptions.DBusException,
+                          self.obj_test.Only2, dbus_interface='org.freedesktop.Test.Sub')
+
+        xml = obj1.Introspect(dbus_interface=dbus.INTROSPECTABLE_IFACE)
+        self.assertTrue('<method name="Do">' in xml, xml)
+        self.assertFalse('Only2' in xml, xml)
+
+    def test_add_objects(self):
+        '''add several objects in one call'''
+
+        errors = self.dbus_mock.AddObjects([
+            ('/obj1', 'org.freedesktop.Test.Sub', {'state': 'online'}, [('Do', '', 's', 'ret = "obj1"')]),
+            ('/obj2', 'org.freedesktop.Test.Sub', {}, [('Do', '', 's', 'ret = "obj2"')]),
+            # duplicate path
+            ('/obj1', 'org.freedesktop.Test.Sub', {}, []),
+            # existing object
+            ('/', 'org.freedesktop.Test.Sub', {}, []),
+            # invalid method code
+            ('/obj3', 'org.freedesktop.Test.Sub', {}, [('Do', '', '', 'ret = (')]),
+            ('/obj4', 'org.freedesktop.Test.Sub', {}, []),
+        ], True)
+
+        self.assertEqual(len(errors), 6)
+        self.assertEqual(errors[0], '')
+        self.assertEqual(errors[1], '')
+        self.assertTrue('exists' in errors[2], errors[2])
+        self.assertTrue('exists' in errors[3], errors[3])
+        self.assertNotEqual(errors[4], '')
+        self.assertEqual(errors[5], '')
+
+        for name in ('obj1', 'obj2'):
+            obj = self.dbus_con.get_object('org.freedesktop.Test', '/' + name)
+            self.assertEqual(obj.Do(dbus_interface='org.freedesktop.Test.Sub'), name)
+        obj1_props = dbus.Interface(self.dbus_con.get_object('org.freedesktop.Test', '/obj1'),
+                                    dbus.PROPERTIES_IFACE)
+        self.assertEqual(obj1_props.Get('org.freedesktop.Test.Sub', 'state'), 'online')
+
+        # failed object did not get created, and can be added again
+        self.dbus_mock.AddMethod('', 'EnumObjs', '', 'ao', 'ret = objects.keys()')
+        self.assertEqual(sorted(self.dbus_test.EnumObjs()), ['/', '/obj1', '/obj2', '/obj4'])
+        self.assertEqual(self.dbus_mock.AddObjects([('/obj3', 'org.freedesktop.Test.Sub', {}, [])], False),
+                         [''])
+
+        xml = self.obj_test.Introspect(dbus_interface=dbus.INTROSPECTABLE_IFACE)
+        self.assertTrue('<node name="obj3"/>' in xml, xml)
+
+    def test_add_objects_invalid_path(self):
+        '''add objects with an invalid path'''
+
+        # restart the mock to check its stderr
+        self.p_mock.terminate()
+        self.p_mock.wait()
+        with tempfile.TemporaryFile() as err:
+            self.p_mock = subprocess.Popen([sys.executable, '-m', 'dbusmock',
+                                            'org.freedesktop.Test', '/', 'org.freedesktop.Test.Main'],
+                                           stdout=self.mock_log, stderr=err)
+            self.wait_for_bus_object('org.freedesktop.Test', '/')
+            dbus_mock = dbus.Interface(self.dbus_con.get_object('org.freedesktop.Test', '/'),
+                                       dbusmock.MOCK_IFACE)
+
+            errors = dbus_mock.AddObjects([('bad', 'org.freedesktop.Test.Sub', {}, []),
+                                           ('/good', 'org.freedesktop.Test.Sub', {}, [])], False)
+            self.assertNotEqual(errors[0], '')
+            self.assertEqual(errors[1], '')
+
+            # the half-constructed object goes away without errors
+            err.seek(0)
+            out = err.read()
+            self.assertFalse(b'AttributeError' in out, out)
+
     def test_add_object_existing(self):
         '''try to add an existing object'''
 
@@ -281,6 +446,115 @@ assert args[2] == 5
         self.assertEqual(self.dbus_props.Get('org.freedesktop.Test.Other', 'color'),
                          'yellow')
 
+    def test_property_helpers(self):
+        '''get_property() and set_property() in method code'''
+
+        self.dbus_mock.AddProperty('', 'Count', dbus.Int32(2))
+        self.dbus_mock.AddMethod('', 'Double', '', 'i',
+                                 'self.set_property("", "Count", self.get_property("", "Count") * 2); '
+                                 'ret = self.get_property("org.freedesktop.Test.Main", "Count")')
+        self.dbus_mock.AddMethod('', 'GetUnknown', 's', 'i',
+                                 'ret = self.get_property(args[0], "Unknown")')
+
+        self.assertEqual(self.dbus_test.Double(), 4)
+        self.assertEqual(self.dbus_props.Get('org.freedesktop.Test.Main', 'Count'), 4)
+
+        try:
+            self.dbus_test.GetUnknown('')
+            self.fail('GetUnknown() for unknown property should fail')
+        except dbus.exceptions.DBusException as e:
+            self.assertTrue('UnknownProperty' in str(e), str(e))
+        try:
+            self.dbus_test.GetUnknown('org.freedesktop.Test.Other')
+            self.fail('GetUnknown() for unknown interface should fail')
+        except dbus.exceptions.DBusException as e:
+            self.assertTrue('UnknownInterface' in str(e), str(e))
+
+    def test_properties_changed(self):
+        '''Set() emits coalesced PropertiesChanged signals'''
+
+        loop = GLib.MainLoop()
+        caught = []
+        self.dbus_props.connect_to_signal('PropertiesChanged',
+                                          lambda iface, changed, inval: caught.append((iface, changed)))
+
+        def run_loop(timeout=500):
+            GLib.timeout_add(timeout, loop.quit)
+            loop.run()
+
+        self.dbus_mock.AddProperties('', {'version': dbus.Int32(1), 'connected': False})
+        self.dbus_mock.AddProperty('org.freedesktop.Test.Other', 'color', 'red')
+        self.dbus_mock.AddMethod('', 'Update', '', '', '''self.set_property("", "version", 2)
+self.set_property("", "version", 3)
+self.set_property("", "connected", True)
+self.set_property("org.freedesktop.Test.Other", "color", "blue")''')
+
+        # all changes in one main loop iteration get merged per interface
+        self.dbus_test.Update()
+        run_loop()
+        self.assertEqual(sorted(caught), [
+            ('org.freedesktop.Test.Main', {'version': 3, 'connected': True}),
+            ('org.freedesktop.Test.Other', {'color': 'blue'}),
+        ])
+
+        # changes within the window get merged
+        del caught[:]
+        self.dbus_mock.SetPropertiesChangedPolicy(True, 1000)
+        self.dbus_props.Set('org.freedesktop.Test.Main', 'version', dbus.Int32(4, variant_level=1))
+        self.dbus_props.Set('org.freedesktop.Test.Main', 'version', dbus.Int32(5, variant_level=1))
+        run_loop(2000)
+        self.assertEqual(caught, [('org.freedesktop.Test.Main', {'version': 5})])
+
+        # disabled
+        del caught[:]
+        self.dbus_mock.SetPropertiesChangedPolicy(False, 0)
+        self.dbus_props.Set('org.freedesktop.Test.Main', 'version', dbus.Int32(6, variant_level=1))
+        run_loop()
+        self.assertEqual(caught, [])
+        self.assertEqual(self.dbus_props.Get('org.freedesktop.Test.Main', 'version'), 6)
+
+    def test_update_properties(self):
+        '''change properties of several objects at once'''
+
+        loop = GLib.MainLoop()
+        caught = []
+        self.dbus_con.add_signal_receiver(
+            lambda iface, changed, inval, path: caught.append((path, iface, changed)),
+            signal_name='PropertiesChanged', dbus_interface=dbus.PROPERTIES_IFACE,
+            path_keyword='path')
+
+        self.dbus_mock.AddProperty('', 'version', dbus.Int32(1))
+        self.dbus_mock.AddObject('/obj1', 'org.freedesktop.Test.Sub',
+                                 {'state': 'offline', 'level': dbus.UInt32(0)}, [])
+        obj1_props = dbus.Interface(self.dbus_con.get_object('org.freedesktop.Test', '/obj1'),
+                                    dbus.PROPERTIES_IFACE)
+
+        self.dbus_mock.UpdateProperties({
+            '/': {'': {'version': dbus.Int32(2)}},
+            '/obj1': {'org.freedesktop.Test.Sub': {'state': 'online', 'level': dbus.UInt32(5)}},
+        })
+        self.assertEqual(self.dbus_props.Get('org.freedesktop.Test.Main', 'version'), 2)
+        self.assertEqual(obj1_props.GetAll('org.freedesktop.Test.Sub'),
+                         {'state': 'online', 'level': 5})
+
+        GLib.timeout_add(500, loop.quit)
+        loop.run()
+        self.assertEqual(sorted(caught), [
+            ('/', 'org.freedesktop.Test.Main', {'version': 2}),
+            ('/obj1', 'org.freedesktop.Test.Sub', {'state': 'online', 'level': 5}),
+        ])
+
+        # nothing gets changed if one property does not exist
+        for bad in ({'/nonexisting': {'': {'version': dbus.Int32(3)}}},
+                    {'/obj1': {'org.freedesktop.Test.Other': {'state': 'broken'}}},
+                    {'/obj1': {'': {'color': 'red'}}}):
+            changes = {'/': {'': {'version': dbus.Int32(3)}}}
+            changes.update(bad)
+            self.assertRaises(dbus.exceptions.DBusException,
+                              self.dbus_mock.UpdateProperties, changes)
+        self.assertEqual(self.dbus_props.Get('org.freedesktop.Test.Main', 'version'), 2)
+        self.assertEqual(obj1_props.Get('org.freedesktop.Test.Sub', 'state'), 'online')
+
     def test_introspection_methods(self):
         '''dynamically added methods appear in introspection'''
 
@@ -315,6 +589,23 @@ assert args[2] == 5
     #    self.assertTrue('<property name="Color" type="s" access="read" />' in xml, xml)
     #    self.assertTrue('<property name="Count" type="i" access="read" />' in xml, xml)
 
+    def test_introspection_children(self):
+        '''introspection follows added and removed child objects'''
+
+        dbus_introspect = dbus.Interface(self.obj_test, dbus.INTROSPECTABLE_IFACE)
+        xml = dbus_introspect.Introspect()
+        self.assertFalse('<node name="obj1"/>' in xml, xml)
+        # cached result is identical
+        self.assertEqual(dbus_introspect.Introspect(), xml)
+
+        self.dbus_mock.AddObject('/obj1', 'org.freedesktop.Test.Sub', {}, [])
+        xml = dbus_introspect.Introspect()
+        self.assertTrue('<node name="obj1"/>' in xml, xml)
+
+        self.dbus_mock.RemoveObject('/obj1')
+        xml = dbus_introspect.Introspect()
+        self.assertFalse('<node name="obj1"/>' in xml, xml)
+
     def test_objects_map(self):
         '''access global objects map'''
 
@@ -324,6 +615,30 @@ assert args[2] == 5
         self.dbus_mock.AddObject('/obj1', 'org.freedesktop.Test.Sub', {}, [])
         self.assertEqual(set(self.dbus_test.EnumObjs()), {'/', '/obj1'})
 
+    def test_objects_tree(self):
+        '''find objects below a path'''
+
+        self.dbus_mock.AddMethod('', 'Children', 's', 'ao', 'ret = get_children(args[0])')
+        self.dbus_mock.AddMethod('', 'Below', 's', 'ao', 'ret = get_objects(args[0])')
+
+        self.dbus_mock.AddObject('/a/b/c', 'org.freedesktop.Test.Sub', {}, [])
+        self.dbus_mock.AddObject('/a/b/d', 'org.freedesktop.Test.Sub', {}, [])
+        self.dbus_mock.AddObject('/a', 'org.freedesktop.Test.Sub', {}, [])
+        self.dbus_mock.AddObject('/ab', 'org.freedesktop.Test.Sub', {}, [])
+
+        # intermediate paths without an object are skipped
+        self.assertEqual(self.dbus_test.Children('/'), ['/a', '/ab'])
+        self.assertEqual(self.dbus_test.Children('/a'), [])
+        self.assertEqual(self.dbus_test.Children('/a/b'), ['/a/b/c', '/a/b/d'])
+        self.assertEqual(self.dbus_test.Children('/nonexisting'), [])
+        self.assertEqual(self.dbus_test.Below('/a'), ['/a', '/a/b/c', '/a/b/d'])
+        self.assertEqual(self.dbus_test.Below('/a/'), ['/a', '/a/b/c', '/a/b/d'])
+
+        self.dbus_mock.RemoveObject('/a/b/c')
+        self.dbus_mock.RemoveObject('/a')
+        self.assertEqual(self.dbus_test.Below('/a'), ['/a/b/d'])
+        self.assertEqual(self.dbus_test.Children('/'), ['/ab'])
+
     def test_signals(self):
         '''emitting signals'''
 
@@ -424,6 +739,253 @@ assert args[2] == 5
         check('i', ['hello'], 'TypeError: an integer is required')
         check('s', [1], 'TypeError: Expected a string')
 
+    def test_signal_stream(self):
+        '''timer driven signal stream'''
+
+        loop = GLib.MainLoop()
+        caught = []
+
+        def catch(*args):
+            caught.append(args)
+            if len(caught) == 20:
+                loop.quit()
+
+        self.dbus_con.add_signal_receiver(catch, signal_name='Tick',
+                                          dbus_interface='org.freedesktop.Test.Main')
+
+        stream = self.dbus_mock.StartSignalStream('', 'Tick', 'us',
+                                                  [[dbus.UInt32(1), 'a'], [dbus.UInt32(2), 'b']],
+                                                  200.0, 20, 0)
+        # method calls still work while the stream is running
+        self.dbus_mock.AddMethod('', 'Do', '', 'i', 'ret = 1')
+        self.assertEqual(self.dbus_test.Do(), 1)
+
+        GLib.timeout_add(5000, loop.quit)
+        loop.run()
+        self.assertEqual(len(caught), 20)
+        self.assertEqual(caught[:3], [(1, 'a'), (2, 'b'), (1, 'a')])
+
+        info = self.dbus_mock.GetSignalStreamInfo(stream)
+        self.assertEqual(info['running'], False)
+        self.assertEqual(info['emitted'], 20)
+        self.assertGreater(info['rate'], 0)
+        self.assertEqual(self.dbus_mock.StopSignalStream(stream)['emitted'], 20)
+        self.assertRaises(dbus.exceptions.DBusException,
+                          self.dbus_mock.GetSignalStreamInfo, stream)
+
+        # unlimited stream until stopped
+        stream = self.dbus_mock.StartSignalStream('', 'Tick', 'us', [[dbus.UInt32(1), 'a']],
+                                                  100.0, 0, 0)
+        GLib.timeout_add(300, loop.quit)
+        loop.run()
+        info = self.dbus_mock.StopSignalStream(stream)
+        self.assertEqual(info['running'], False)
+        self.assertGreater(info['emitted'], 0)
+
+        # removing an object stops its streams
+        self.dbus_mock.AddObject('/sub', 'org.freedesktop.Test.Sub', {}, [])
+        sub_mock = dbus.Interface(self.dbus_con.get_object('org.freedesktop.Test', '/sub'),
+                                  dbusmock.MOCK_IFACE)
+        sub_mock.StartSignalStream('org.freedesktop.Test.Main', 'Tick', 'us',
+                                   [[dbus.UInt32(1), 'a']], 100.0, 0, 0)
+        GLib.timeout_add(200, loop.quit)
+        loop.run()
+        self.dbus_mock.RemoveObject('/sub')
+        # let signals which are already in flight arrive
+        GLib.timeout_add(100, loop.quit)
+        loop.run()
+        del caught[:]
+        GLib.timeout_add(300, loop.quit)
+        loop.run()
+        self.assertEqual(caught, [])
+
+        # invalid arguments
+        self.assertRaises(dbus.exceptions.DBusException, self.dbus_mock.StartSignalStream,
+                          '', 'Tick', 'us', [[dbus.UInt32(1), 'a']], 0.0, 1, 0)
+        self.assertRaises(dbus.exceptions.DBusException, self.dbus_mock.StartSignalStream,
+                          '', 'Tick', 'us', [], 10.0, 1, 0)
+        self.assertRaises(dbus.exceptions.DBusException, self.dbus_mock.StartSignalStream,
+                          '', 'Tick', 'us', [['a']], 10.0, 1, 0)
+
+    def test_deferred_reply(self):
+        '''methods which answer later do not block other calls'''
+
+        self.dbus_mock.AddMethod('', 'Slow', 'i', 'i', '''ret = self.defer_reply()
+GLib.timeout_add(500, lambda r=ret, a=args: r.reply(a[0] * 2))''')
+        self.dbus_mock.AddMethod('', 'SlowFail', '', 'i', '''ret = self.defer_reply()
+GLib.timeout_add(100, lambda r=ret: r.error(dbus.exceptions.DBusException(
+    'out of coffee', name='org.freedesktop.Test.Error')))''')
+        self.dbus_mock.AddMethod('', 'Fast', '', 's', 'ret = "fast"')
+        # answering right away works, too
+        self.dbus_mock.AddMethod('', 'Immediate', '', 's', 'ret = self.defer_reply(); ret.reply("now")')
+
+        loop = GLib.MainLoop()
+        results = []
+
+        def done(name, value):
+            results.append((name, value))
+            if len(results) == 2:
+                loop.quit()
+
+        start = time.time()
+        self.dbus_test.Slow(21, reply_handler=lambda v: done('slow', v),
+                            error_handler=lambda e: done('slow', e))
+        self.dbus_test.Fast(reply_handler=lambda v: done('fast', v),
+                            error_handler=lambda e: done('fast', e))
+        GLib.timeout_add(5000, loop.quit)
+        loop.run()
+
+        self.assertEqual(results, [('fast', 'fast'), ('slow', 42)])
+        self.assertGreater(time.time() - start, 0.4)
+        self.assertEqual(self.dbus_test.Immediate(), 'now')
+
+        try:
+            self.dbus_test.SlowFail()
+            self.fail('SlowFail() should raise an error')
+        except dbus.exceptions.DBusException as e:
+            self.assertEqual(e.get_dbus_name(), 'org.freedesktop.Test.Error')
+            self.assertTrue('out of coffee' in str(e), str(e))
+
+        # calls are logged when they come in
+        self.assertEqual(self.dbus_mock.GetMethodCallCount('Slow'), 1)
+
+    def test_latency(self):
+        '''delayed replies with latency models'''
+
+        self.dbus_mock.AddMethod('', 'Do', 'i', 'i', 'ret = args[0]')
+        self.dbus_mock.AddMethod('', 'Fast', '', '', '')
+        self.dbus_mock.SetLatency('', 'Do', 'fixed', [300])
+
+        loop = GLib.MainLoop()
+        results = []
+
+        def done(value):
+            results.append(value)
+            if len(results) == 4:
+                loop.quit()
+
+        # concurrent calls overlap, and do not block other methods
+        start = time.time()
+        for i in range(3):
+            self.dbus_test.Do(i, reply_handler=done, error_handler=done)
+        self.dbus_test.Fast(reply_handler=lambda: done('fast'), error_handler=done)
+        GLib.timeout_add(5000, loop.quit)
+        loop.run()
+        self.assertEqual(results, ['fast', 0, 1, 2])
+        self.assertLess(time.time() - start, 0.8)
+
+        latencies = self.dbus_mock.GetCallLatencies('Do')
+        self.assertEqual(len(latencies), 3)
+        for (seq, method, injected, actual) in latencies:
+            self.assertEqual(method, 'Do')
+            self.assertAlmostEqual(injected, 0.3)
+            self.assertGreaterEqual(actual, 0.29)
+        (seq, method, injected, actual) = self.dbus_mock.GetCallLatencies('Fast')[0]
+        self.assertEqual(injected, 0)
+        self.assertLess(actual, 0.3)
+
+        # default for all other methods, with reproducible delays
+        self.dbus_mock.SetLatency('', '', 'uniform', [10, 50])
+        self.dbus_mock.ClearCalls()
+        self.dbus_mock.SeedLatency(42)
+        for i in range(3):
+            self.dbus_test.Fast()
+        self.dbus_mock.SeedLatency(42)
+        for i in range(3):
+            self.dbus_test.Fast()
+        injected = [l[2] for l in self.dbus_mock.GetCallLatencies('Fast')]
+        self.assertEqual(injected[:3], injected[3:])
+        for l in injected:
+            self.assertTrue(0.01 <= l <= 0.05, l)
+
+        # "none" overrides the default
+        self.dbus_mock.SetLatency('', 'Fast', 'none', [])
+        self.dbus_test.Fast()
+        self.assertEqual(self.dbus_mock.GetCallLatencies('Fast')[-1][2], 0)
+
+        # errors get delayed, too
+        self.dbus_mock.AddMethod('', 'Fail', '', '', 'raise dbus.exceptions.DBusException("no")')
+        self.dbus_mock.SetLatency('', 'Fail', 'fixed', [200])
+        start = time.time()
+        self.assertRaises(dbus.exceptions.DBusException, self.dbus_test.Fail)
+        self.assertGreaterEqual(time.time() - start, 0.19)
+
+        # return values which do not match the signature result in an error
+        # instead of no reply at all
+        self.dbus_mock.AddMethod('', 'Wrong', '', 'i', 'ret = "notanint"')
+        self.dbus_mock.SetLatency('', 'Wrong', 'fixed', [10])
+        try:
+            self.dbus_test.Wrong(timeout=5)
+            self.fail('Wrong() should raise an error')
+        except dbus.exceptions.DBusException as e:
+            self.assertEqual(e.get_dbus_name(), 'org.freedesktop.DBus.Python.TypeError')
+
+        # invalid models
+        self.assertRaises(dbus.exceptions.DBusException,
+                          self.dbus_mock.SetLatency, '', 'Do', 'slow', [1])
+        self.assertRaises(dbus.exceptions.DBusException,
+                          self.dbus_mock.SetLatency, '', 'Do', 'uniform', [1])
+        self.assertRaises(dbus.exceptions.DBusException,
+                          self.dbus_mock.SetLatency, '', 'Do', 'fixed', [-1])
+
+    def test_threaded_method(self):
+        '''expensive methods in worker threads'''
+
+        self.dbus_mock.AddProperty('', 'factor', dbus.Int32(2))
+        self.dbus_mock.AddMethod('', 'Heavy', 'i', 'i', '''end = time.time() + 0.5
+while time.time() < end:
+    pass
+ret = args[0] * self.call_in_main_loop(self.get_property, "", "factor")''')
+        self.dbus_mock.AddMethod('', 'Fail', '', '', 'raise dbus.exceptions.DBusException("no", name="org.freedesktop.Test.Error")')
+        self.dbus_mock.AddMethod('', 'Fast', '', 's', 'ret = "fast"')
+        self.dbus_mock.SetMethodThreaded('', 'Heavy', True)
+        self.dbus_mock.SetMethodThreaded('', 'Fail', True)
+        self.assertRaises(dbus.exceptions.DBusException,
+                          self.dbus_mock.SetMethodThreaded, '', 'Nonexisting', True)
+
+        loop = GLib.MainLoop()
+        results = []
+
+        def done(value):
+            results.append(value)
+            if len(results) == 2:
+                loop.quit()
+
+        self.dbus_test.Heavy(21, reply_handler=done, error_handler=done)
+        self.dbus_test.Heavy(1, reply_handler=done, error_handler=done)
+        # the mock keeps answering other calls in the meantime
+        start = time.time()
+        self.assertEqual(self.dbus_test.Fast(), 'fast')
+        self.assertLess(time.time() - start, 0.4)
+        info = self.dbus_mock.GetWorkerPoolInfo()
+        self.assertEqual(info['running'] + info['queued'], 2)
+
+        GLib.timeout_add(5000, loop.quit)
+        loop.run()
+        self.assertEqual(sorted(results), [2, 42])
+
+        try:
+            self.dbus_test.Fail()
+            self.fail('Fail() should raise an error')
+        except dbus.exceptions.DBusException as e:
+            self.assertEqual(e.get_dbus_name(), 'org.freedesktop.Test.Error')
+
+        # return values which do not match the signature result in an error
+        # instead of no reply at all
+        self.dbus_mock.AddMethod('', 'Wrong', '', 'i', 'ret = "notanint"')
+        self.dbus_mock.SetMethodThreaded('', 'Wrong', True)
+        try:
+            self.dbus_test.Wrong(timeout=5)
+            self.fail('Wrong() should raise an error')
+        except dbus.exceptions.DBusException as e:
+            self.assertEqual(e.get_dbus_name(), 'org.freedesktop.DBus.Python.TypeError')
+
+        info = self.dbus_mock.GetWorkerPoolInfo()
+        self.assertEqual(info['completed'], 4)
+        self.assertEqual(info['running'], 0)
+        self.assertEqual(info['queued'], 0)
+        self.assertEqual(info['threads'], 4)
+
     def test_dbus_get_log(self):
         '''query call logs over D-BUS'''
 
@@ -455,6 +1017,70 @@ assert args[2] == 5
         self.assertEqual(self.dbus_mock.ClearCalls(), None)
         self.assertEqual(self.dbus_mock.GetCalls(), dbus.Array([]))
 
+    def test_dbus_call_log_capacity(self):
+        '''bounded call log'''
+
+        info = self.dbus_mock.GetCallLogInfo()
+        self.assertEqual(info, {'capacity': 0, 'size': 0, 'dropped': 0, 'last_seq': 0})
+
+        self.dbus_mock.AddMethod('', 'Do', 'i', '', '')
+        self.dbus_mock.SetCallLogCapacity(3)
+        for i in range(5):
+            self.dbus_test.Do(i)
+
+        mock_log = self.dbus_mock.GetCalls()
+        self.assertEqual([c[2][0] for c in mock_log], [2, 3, 4])
+        self.assertEqual(self.dbus_mock.GetCallLogInfo(),
+                         {'capacity': 3, 'size': 3, 'dropped': 2, 'last_seq': 5})
+
+        # shrinking drops the oldest entries
+        self.dbus_mock.SetCallLogCapacity(1)
+        self.assertEqual([c[1][0] for c in self.dbus_mock.GetMethodCalls('Do')], [4])
+        self.assertEqual(self.dbus_mock.GetCallLogInfo(),
+                         {'capacity': 1, 'size': 1, 'dropped': 4, 'last_seq': 5})
+
+        self.dbus_mock.ClearCalls()
+        self.assertEqual(self.dbus_mock.GetCallLogInfo(),
+                         {'capacity': 1, 'size': 0, 'dropped': 0, 'last_seq': 5})
+
+    def test_dbus_get_calls_since(self):
+        '''incrementally query call logs over D-BUS'''
+
+        self.assertEqual(self.dbus_mock.GetCallsSince(0, 0), dbus.Array([]))
+
+        self.dbus_mock.AddMethod('', 'Do', 'i', '', '')
+        for i in range(5):
+            self.dbus_test.Do(i)
+
+        calls = self.dbus_mock.GetCallsSince(0, 0)
+        self.assertEqual([c[0] for c in calls], [1, 2, 3, 4, 5])
+        self.assertGreater(calls[0][1], 10000)  # timestamp
+        self.assertEqual(calls[0][2], 'Do')
+        self.assertEqual([c[3][0] for c in calls], [0, 1, 2, 3, 4])
+
+        # paging
+        calls = self.dbus_mock.GetCallsSince(0, 2)
+        self.assertEqual([c[0] for c in calls], [1, 2])
+        calls = self.dbus_mock.GetCallsSince(calls[-1][0], 2)
+        self.assertEqual([c[0] for c in calls], [3, 4])
+        calls = self.dbus_mock.GetCallsSince(calls[-1][0], 2)
+        self.assertEqual([c[0] for c in calls], [5])
+        self.assertEqual(self.dbus_mock.GetCallsSince(5, 2), dbus.Array([]))
+
+        # tail
+        self.assertEqual(self.dbus_mock.GetCallLogInfo()['last_seq'], 5)
+        self.dbus_test.Do(42)
+        calls = self.dbus_mock.GetCallsSince(5, 0)
+        self.assertEqual([(c[0], c[3][0]) for c in calls], [(6, 42)])
+
+        # sequence numbers continue after clearing and dropping
+        self.dbus_mock.ClearCalls()
+        self.dbus_mock.SetCallLogCapacity(2)
+        for i in range(3):
+            self.dbus_test.Do(i)
+        self.assertEqual([c[0] for c in self.dbus_mock.GetCallsSince(0, 0)], [8, 9])
+        self.assertEqual([c[0] for c in self.dbus_mock.GetCallsSince(8, 0)], [9])
+
     def test_dbus_get_method_calls(self):
         '''query method call logs over D-BUS'''
 
@@ -478,6 +1104,24 @@ assert args[2] == 5
         self.assertGreater(mock_calls[1][0], 10000)  # timestamp
         self.assertEqual(mock_calls[1][1], ['bar'])
 
+        self.assertEqual(self.dbus_mock.GetMethodCallCount('Do'), 2)
+        self.assertEqual(self.dbus_mock.GetMethodCallCount('Wop'), 2)
+        self.assertEqual(self.dbus_mock.GetMethodCallCount('Nonexisting'), 0)
+        self.assertEqual(self.dbus_mock.GetMethodCalls('Nonexisting'), dbus.Array([]))
+
+        # index follows evictions
+        self.dbus_mock.SetCallLogCapacity(3)
+        self.assertEqual(self.dbus_mock.GetMethodCallCount('Do'), 1)
+        self.assertEqual(len(self.dbus_mock.GetMethodCalls('Do')), 1)
+        self.dbus_mock.SetCallLogCapacity(2)
+        self.assertEqual(self.dbus_mock.GetMethodCallCount('Do'), 0)
+        self.assertEqual(self.dbus_mock.GetMethodCalls('Do'), dbus.Array([]))
+        self.assertEqual([c[1] for c in self.dbus_mock.GetMethodCalls('Wop')],
+                         [['foo'], ['bar']])
+
+        self.dbus_mock.ClearCalls()
+        self.assertEqual(self.dbus_mock.GetMethodCallCount('Wop'), 0)
+
     def test_dbus_method_called(self):
         '''subscribe to MethodCalled signal'''
 
@@ -501,6 +1145,281 @@ assert args[2] == 5
         self.assertEqual(len(args), 1)
         self.assertEqual(args[0], 'foo')
 
+    def test_dbus_method_called_modes(self):
+        '''disable or aggregate MethodCalled signals'''
+
+        loop = GLib.MainLoop()
+        caught_single = []
+        caught_multi = []
+
+        self.dbus_mock.AddMethod('', 'Do', 'i', '', '')
+        self.dbus_mock.connect_to_signal('MethodCalled',
+                                         lambda method, args: caught_single.append(args[0]))
+        self.dbus_mock.connect_to_signal('MethodsCalled',
+                                         lambda calls: caught_multi.append([c[1][0] for c in calls]))
+
+        def run_loop(timeout=500):
+            GLib.timeout_add(timeout, loop.quit)
+            loop.run()
+
+        self.dbus_mock.SetMethodCalledMode('off', 0)
+        self.dbus_test.Do(1)
+        run_loop()
+        self.assertEqual(caught_single, [])
+        self.assertEqual(caught_multi, [])
+
+        self.dbus_mock.SetMethodCalledMode('aggregate', 1000)
+        for i in range(5):
+            self.dbus_test.Do(i)
+        run_loop(2000)
+        self.assertEqual(caught_single, [])
+        self.assertEqual(caught_multi, [[0, 1, 2, 3, 4]])
+
+        self.dbus_mock.SetMethodCalledMode('signal', 0)
+        self.dbus_test.Do(42)
+        run_loop()
+        self.assertEqual(caught_single, [42])
+        self.assertEqual(caught_multi, [[0, 1, 2, 3, 4]])
+
+        self.assertRaises(dbus.exceptions.DBusException,
+                          self.dbus_mock.SetMethodCalledMode, 'loud', 0)
+
+        # calls are still logged
+        self.assertEqual(self.dbus_mock.GetMethodCallCount('Do'), 7)
+
+    def test_object_manager(self):
+        '''org.freedesktop.DBus.ObjectManager on the main object'''
+
+        # restart the mock with an object manager
+        self.p_mock.terminate()
+        self.p_mock.wait()
+        self.p_mock = subprocess.Popen([sys.executable, '-m', 'dbusmock', '-m',
+                                        'org.freedesktop.Test', '/', 'org.freedesktop.Test.Main'],
+                                       stdout=self.mock_log)
+        self.wait_for_bus_object('org.freedesktop.Test', '/')
+        obj_test = self.dbus_con.get_object('org.freedesktop.Test', '/')
+        dbus_mock = dbus.Interface(obj_test, dbusmock.MOCK_IFACE)
+        dbus_om = dbus.Interface(obj_test, dbusmock.OBJECT_MANAGER_IFACE)
+
+        loop = GLib.MainLoop()
+        added = []
+        removed = []
+        dbus_om.connect_to_signal('InterfacesAdded',
+                                  lambda path, ifaces: added.append((path, ifaces)))
+        dbus_om.connect_to_signal('InterfacesRemoved',
+                                  lambda path, ifaces: removed.append((path, ifaces)))
+
+        self.assertEqual(dbus_om.GetManagedObjects(), {})
+
+        dbus_mock.AddObject('/obj1', 'org.freedesktop.Test.Sub', {'state': 'online'},
+                            [('Do', '', '', '')])
+        obj1 = self.dbus_con.get_object('org.freedesktop.Test', '/obj1')
+        obj1.Do(dbus_interface='org.freedesktop.Test.Sub')
+        dbus_mock.AddObject('/obj1/child', 'org.freedesktop.Test.Sub', {}, [])
+        self.assertEqual(dbus_om.GetManagedObjects(), {
+            '/obj1': {'org.freedesktop.Test.Sub': {'state': 'online'}},
+            '/obj1/child': {'org.freedesktop.Test.Sub': {}},
+        })
+
+        dbus_mock.RemoveObject('/obj1')
+        self.assertEqual(list(dbus_om.GetManagedObjects().keys()), ['/obj1/child'])
+        # removed object is gone from the bus
+        self.assertRaises(dbus.exceptions.DBusException, obj1.Do,
+                          dbus_interface='org.freedesktop.Test.Sub')
+
+        GLib.timeout_add(500, loop.quit)
+        loop.run()
+        self.assertEqual(added, [('/obj1', {'org.freedesktop.Test.Sub': {'state': 'online'}}),
+                                 ('/obj1/child', {'org.freedesktop.Test.Sub': {}})])
+        self.assertEqual(removed, [('/obj1', ['org.freedesktop.Test.Sub'])])
+
+        # objects without -m do not have the interface
+        self.assertRaises(dbus.exceptions.DBusException,
+                          self.dbus_con.get_object('org.freedesktop.Test', '/obj1/child').GetManagedObjects,
+                          dbus_interface=dbusmock.OBJECT_MANAGER_IFACE)
+
+    def test_object_manager_new_interface(self):
+        '''InterfacesAdded for interfaces added to existing objects'''
+
+        self.p_mock.terminate()
+        self.p_mock.wait()
+        self.p_mock = subprocess.Popen([sys.executable, '-m', 'dbusmock', '-m',
+                                        'org.freedesktop.Test', '/', 'org.freedesktop.Test.Main'],
+                                       stdout=self.mock_log)
+        self.wait_for_bus_object('org.freedesktop.Test', '/')
+        obj_test = self.dbus_con.get_object('org.freedesktop.Test', '/')
+        dbus.Interface(obj_test, dbusmock.MOCK_IFACE).AddTemplate('networkmanager', {})
+        dbus_om = dbus.Interface(obj_test, dbusmock.OBJECT_MANAGER_IFACE)
+
+        loop = GLib.MainLoop()
+        added = []
+        dbus_om.connect_to_signal('InterfacesAdded',
+                                  lambda path, ifaces: added.append((path, ifaces)))
+
+        # the template adds the Device.Wired object, then the Device properties
+        dbus_nm = dbus.Interface(self.dbus_con.get_object('org.freedesktop.Test', '/'),
+                                 dbusmock.MOCK_IFACE)
+        path = dbus_nm.AddEthernetDevice('mock_Ethernet1', 'eth0', 20)
+        # no signal for new properties on known interfaces
+        obj_dev = self.dbus_con.get_object('org.freedesktop.Test', path)
+        obj_dev.AddProperty('org.freedesktop.NetworkManager.Device', 'Foo', 'x',
+                            dbus_interface=dbusmock.MOCK_IFACE)
+
+        GLib.timeout_add(500, loop.quit)
+        loop.run()
+
+        managed = dbus_om.GetManagedObjects()[path]
+        self.assertEqual(sorted(managed.keys()), ['org.freedesktop.NetworkManager.Device',
+                                                  'org.freedesktop.NetworkManager.Device.Wired'])
+        self.assertEqual([p for (p, ifaces) in added], [path, path])
+        self.assertEqual(list(added[0][1].keys()), ['org.freedesktop.NetworkManager.Device.Wired'])
+        self.assertEqual(list(added[1][1].keys()), ['org.freedesktop.NetworkManager.Device'])
+        self.assertEqual(added[1][1]['org.freedesktop.NetworkManager.Device']['Interface'], 'eth0')
+        self.assertFalse('Foo' in added[1][1]['org.freedesktop.NetworkManager.Device'])
+
+    def test_snapshots(self):
+        '''save and restore snapshots of all objects'''
+
+        self.dbus_mock.AddTemplate('polkitd', {})
+        self.dbus_mock.AddProperty('', 'state', 'idle')
+        self.dbus_mock.AddObjects([
+            ('/dev%i' % i, 'org.freedesktop.Test.Sub', {'index': dbus.UInt32(i)},
+             [('Index', '', 'u', 'ret = %i' % i)]) for i in range(3)], False)
+        dbus_props = dbus.Interface(self.obj_test, dbus.PROPERTIES_IFACE)
+        # self.obj_test got introspected before loading the template, so it
+        # does not know the signature of CheckAuthorization()
+        dbus_polkit = dbus.Interface(self.dbus_con.get_object('org.freedesktop.Test', '/'),
+                                     'org.freedesktop.PolicyKit1.Authority')
+
+        def check_allowed(action):
+            subject = ('unix-process', {'pid': dbus.UInt32(1, variant_level=1)})
+            return dbus_polkit.CheckAuthorization(subject, action, {}, 0, '')[0]
+
+        def dev(i):
+            return self.dbus_con.get_object('org.freedesktop.Test', '/dev%i' % i, introspect=False)
+
+        self.dbus_mock.SaveSnapshot('base')
+        self.assertEqual(self.dbus_mock.ListSnapshots(), ['base'])
+
+        for variant in range(2):
+            # change a bit of everything
+            self.dbus_mock.SetAllowed(['org.freedesktop.test.frobnicate'])
+            self.assertTrue(check_allowed('org.freedesktop.test.frobnicate'))
+            dbus_props.Set('org.freedesktop.Test.Main', 'state', 'busy')
+            self.dbus_mock.AddMethod('', 'Extra', '', 'i', 'ret = %i' % variant)
+            self.assertEqual(self.dbus_test.Extra(), variant)
+            self.dbus_mock.RemoveObject('/dev1')
+            self.dbus_mock.AddObject('/dev2/child', 'org.freedesktop.Test.Sub', {}, [])
+            self.dbus_mock.AddObject('/new', 'org.freedesktop.Test.Sub', {}, [('New', '', '', '')])
+
+            self.dbus_mock.RestoreSnapshot('base')
+
+            self.assertFalse(check_allowed('org.freedesktop.test.frobnicate'))
+            self.assertEqual(dbus_props.Get('org.freedesktop.Test.Main', 'state'), 'idle')
+            self.assertRaises(dbus.exceptions.DBusException, self.dbus_test.Extra)
+            for i in range(3):
+                self.assertEqual(dev(i).Index(dbus_interface='org.freedesktop.Test.Sub'), i)
+            new = self.dbus_con.get_object('org.freedesktop.Test', '/new', introspect=False)
+            self.assertRaises(dbus.exceptions.DBusException, new.New,
+                              dbus_interface='org.freedesktop.Test.Sub')
+            xml = self.obj_test.Introspect(dbus_interface=dbus.INTROSPECTABLE_IFACE)
+            self.assertFalse('Extra' in xml, xml)
+            self.assertTrue('<node name="dev1"/>' in xml, xml)
+            self.assertFalse('<node name="new"/>' in xml, xml)
+
+        self.dbus_mock.RemoveSnapshot('base')
+        self.assertEqual(self.dbus_mock.ListSnapshots(), [])
+        self.assertRaises(dbus.exceptions.DBusException, self.dbus_mock.RestoreSnapshot, 'base')
+        self.assertRaises(dbus.exceptions.DBusException, self.dbus_mock.RemoveSnapshot, 'base')
+
+    def test_save_load_state(self):
+        '''save objects into a state file and load them again'''
+
+        props = {
+            'byte': dbus.Byte(7),
+            'uint64': dbus.UInt64(0xffffffffffffffff),
+            'double': dbus.Double(1.5),
+            'path': dbus.ObjectPath('/a/b'),
+            'bytes': dbus.Array([dbus.Byte(1), dbus.Byte(2)], signature='y'),
+            'int_map': dbus.Dictionary({dbus.Int32(1): 'one'}, signature='is'),
+            'struct': dbus.Struct(('x', dbus.UInt32(1)), signature='su'),
+            'variant_map': dbus.Dictionary({'a': dbus.Int16(-1, variant_level=1),
+                                            'b': dbus.Array(['x'], signature='s', variant_level=1)},
+                                           signature='sv'),
+        }
+        self.dbus_mock.AddObject('/obj1', 'org.freedesktop.Test.Sub', props,
+                                 [('Do', 'u', 'u', 'ret = args[0] * 2'), ('Nop', '', '', '')])
+        self.dbus_mock.AddObject('/obj1/child', 'org.freedesktop.Test.Sub', {}, [])
+        self.dbus_mock.AddMethod('', 'Hello', '', 's', 'ret = "world"')
+        self.dbus_mock.AddProperty('', 'state', 'online')
+
+        with tempfile.NamedTemporaryFile(suffix='.json') as state:
+            self.dbus_mock.SaveState(state.name)
+
+            # objects must not exist yet
+            self.assertRaises(dbus.exceptions.DBusException, self.dbus_mock.LoadState, state.name)
+
+            self.dbus_mock.RemoveObject('/obj1')
+            self.dbus_mock.RemoveObject('/obj1/child')
+            self.dbus_mock.LoadState(state.name)
+
+        obj1 = self.dbus_con.get_object('org.freedesktop.Test', '/obj1')
+        self.assertEqual(obj1.Do(21, dbus_interface='org.freedesktop.Test.Sub'), 42)
+        loaded = obj1.GetAll('org.freedesktop.Test.Sub', dbus_interface=dbus.PROPERTIES_IFACE)
+        self.assertEqual(loaded, props)
+        for (name, value) in props.items():
+            self.assertEqual(type(loaded[name]), type(value), name)
+        self.assertEqual(loaded['int_map'].signature, 'is')
+        self.assertEqual(type(loaded['variant_map']['a']), dbus.Int16)
+        self.assertTrue('<node name="child"/>' in obj1.Introspect(dbus_interface=dbus.INTROSPECTABLE_IFACE))
+        self.assertEqual(self.dbus_test.Hello(), 'world')
+
+        # invalid files
+        with tempfile.NamedTemporaryFile(suffix='.json') as state:
+            state.write(b'{"version": 1, "objects": [{"path": "/obj2", "interface": "a.b", '
+                        b'"properties": {"a.b": {"x": ["u", -1]}}}]}')
+            state.flush()
+            self.assertRaises(dbus.exceptions.DBusException, self.dbus_mock.LoadState, state.name)
+        self.assertRaises(dbus.exceptions.DBusException, self.dbus_mock.LoadState, '/nonexisting')
+        # malformed entries
+        for objs in [b'[{"nopath": 1}]', b'[1]', b'{"a": 1}']:
+            with tempfile.NamedTemporaryFile(suffix='.json') as state:
+                state.write(b'{"version": 1, "objects": ' + objs + b'}')
+                state.flush()
+                try:
+                    self.dbus_mock.LoadState(state.name)
+                    self.fail('LoadState() should fail for %s' % objs)
+                except dbus.exceptions.DBusException as e:
+                    self.assertEqual(e.get_dbus_name(), 'org.freedesktop.DBus.Mock.InvalidArgs')
+        # nothing got created
+        obj2 = self.dbus_con.get_object('org.freedesktop.Test', '/obj2')
+        self.assertRaises(dbus.exceptions.DBusException, obj2.GetAll, 'a.b',
+                          dbus_interface=dbus.PROPERTIES_IFACE)
+
+        # an invalid entry for this object does not load it partially
+        with tempfile.NamedTemporaryFile(suffix='.json') as state:
+            state.write(b'{"version": 1, "objects": [{"path": "/", "interface": "org.freedesktop.Test.Main", '
+                        b'"methods": {"org.freedesktop.Test.Main": {"Half": ["", "s", "ret = \'x\'"]}}, '
+                        b'"attributes": {"half": ["u", -1]}}]}')
+            state.flush()
+            self.assertRaises(dbus.exceptions.DBusException, self.dbus_mock.LoadState, state.name)
+        obj = self.dbus_con.get_object('org.freedesktop.Test', '/')
+        self.assertRaises(dbus.exceptions.DBusException, obj.Half,
+                          dbus_interface='org.freedesktop.Test.Main')
+
+    def test_load_state_templates(self):
+        '''loading a state does not add templates twice'''
+
+        self.dbus_mock.AddTemplate('upower', dbus.Dictionary({}, signature='sv'))
+        with tempfile.NamedTemporaryFile(suffix='.json') as state:
+            self.dbus_mock.SaveState(state.name)
+            self.dbus_mock.Reset(True)
+            self.dbus_mock.LoadState(state.name)
+
+        # this loads upower once, not twice
+        self.dbus_mock.Reset(True)
+        self.assertEqual(self.dbus_props.Get('org.freedesktop.UPower', 'DaemonVersion'), '0.8.15')
+
 
 class TestTemplates(dbusmock.DBusTestCase):
     '''Test template API'''
@@ -528,6 +1447,116 @@ def load(mock, parameters):
 
         self.assertEqual(dbus_ultimate.Answer(), 42)
 
+    def test_local_function_methods(self):
+        '''Template with Python functions as methods'''
+
+        with tempfile.NamedTemporaryFile(prefix='answer_', suffix='.py') as my_template:
+            my_template.write(b'''import dbus
+BUS_NAME = 'universe.Ultimate'
+MAIN_OBJ = '/'
+MAIN_IFACE = 'universe.Ultimate'
+SYSTEM_BUS = False
+
+def load(mock, parameters):
+    mock.AddMethods(MAIN_IFACE, [('Answer', '', 'i', Answer),
+                                 ('Multiply', 'ii', 'i', Multiply)])
+    mock.factor = 2
+
+def Answer(self):
+    return 42
+
+def Multiply(self, a, b):
+    return a * b * self.factor
+''')
+            my_template.flush()
+            (p_mock, dbus_ultimate) = self.spawn_server_template(
+                my_template.name, stdout=subprocess.PIPE)
+
+        try:
+            self.assertEqual(dbus_ultimate.Answer(), 42)
+            self.assertEqual(dbus_ultimate.Multiply(3, 5), 30)
+
+            # calls get logged
+            dbus_mock = dbus.Interface(dbus_ultimate, dbusmock.MOCK_IFACE)
+            self.assertEqual(dbus_mock.GetMethodCalls('Multiply')[0][1], [3, 5])
+
+            # and appear in introspection
+            xml = dbus_ultimate.Introspect(dbus_interface=dbus.INTROSPECTABLE_IFACE)
+            self.assertTrue('<method name="Multiply">' in xml, xml)
+        finally:
+            p_mock.stdout.close()
+            p_mock.terminate()
+            p_mock.wait()
+
+    def test_reset(self):
+        '''Reset the mock to the template state'''
+
+        with tempfile.NamedTemporaryFile(prefix='answer_', suffix='.py') as my_template:
+            my_template.write(b'''import dbus
+BUS_NAME = 'universe.Ultimate'
+MAIN_OBJ = '/'
+MAIN_IFACE = 'universe.Ultimate'
+SYSTEM_BUS = False
+
+def load(mock, parameters):
+    mock.AddMethods(MAIN_IFACE, [('Multiply', 'i', 'i', Multiply)])
+    mock.AddProperty(MAIN_IFACE, 'Name', parameters.get('name', 'deep thought'))
+    mock.factor = 2
+
+def Multiply(self, a):
+    return a * self.factor
+
+@dbus.service.method('org.freedesktop.DBus.Mock', in_signature='i', out_signature='')
+def SetFactor(self, factor):
+    self.factor = factor
+''')
+            my_template.flush()
+            (p_mock, dbus_ultimate) = self.spawn_server_template(
+                my_template.name, {'name': 'earth'}, stdout=subprocess.PIPE)
+
+        try:
+            dbus_mock = dbus.Interface(dbus_ultimate, dbusmock.MOCK_IFACE)
+            dbus_props = dbus.Interface(dbus_ultimate, dbus.PROPERTIES_IFACE)
+
+            # change everything
+            dbus_mock.SetFactor(3)
+            self.assertEqual(dbus_ultimate.Multiply(2), 6)
+            dbus_props.Set('universe.Ultimate', 'Name', 'heart of gold')
+            dbus_mock.AddMethod('', 'Extra', '', 'i', 'ret = 1')
+            dbus_mock.AddProperty('universe.Other', 'Size', 5)
+            dbus_mock.AddObject('/sub', 'universe.Sub', {}, [('Do', '', 'i', 'ret = 2')])
+
+            self.reset_server(dbus_ultimate)
+
+            # back to the state after loading the template
+            self.assertEqual(dbus_ultimate.Multiply(2), 4)
+            self.assertEqual(dbus_props.Get('universe.Ultimate', 'Name'), 'earth')
+            self.assertRaises(dbus.exceptions.DBusException, dbus_ultimate.Extra)
+            self.assertRaises(dbus.exceptions.DBusException, dbus_props.Get,
+                              'universe.Other', 'Size')
+            sub = self.get_dbus().get_object('universe.Ultimate', '/sub', introspect=False)
+            self.assertRaises(dbus.exceptions.DBusException, sub.Do,
+                              dbus_interface='universe.Sub')
+            self.assertEqual([c[1] for c in dbus_mock.GetCalls()], ['Multiply'])
+            xml = dbus_ultimate.Introspect(dbus_interface=dbus.INTROSPECTABLE_IFACE)
+            self.assertFalse('Extra' in xml, xml)
+            self.assertTrue('<method name="Multiply">' in xml, xml)
+
+            # without the template
+            self.reset_server(dbus_ultimate, False)
+            self.assertRaises(dbus.exceptions.DBusException, dbus_ultimate.Multiply, 2)
+            self.assertRaises(dbus.exceptions.DBusException, dbus_mock.SetFactor, 1)
+            self.assertEqual(dbus_props.GetAll('universe.Ultimate'), {})
+            self.assertEqual(dbus_mock.GetCalls(), [])
+
+            # the mock still works
+            dbus_mock.AddMethod('', 'Answer', '', 'i', 'ret = 42')
+            self.assertEqual(dbus_ultimate.Answer(), 42)
+        finally:
+            p_mock.stdout.close()
+            p_mock.terminate()
+            p_mock.wait()
+
     def test_local_nonexisting(self):
         self.assertRaises(ImportError, self.spawn_server_template, '/non/existing.py')
 
@@ -561,6 +1590,66 @@ class TestCleanup(dbusmock.DBusTestCase):
         self.assertEqual(p_mock.wait(), 0)
 
 
+class TestConverters(unittest.TestCase):
+    '''Argument converters behave like a D-Bus message round trip'''
+
+    def assertSameValue(self, expected, actual):
+        self.assertEqual(type(actual), type(expected))
+        self.assertEqual(getattr(actual, 'variant_level', 0),
+                         getattr(expected, 'variant_level', 0))
+        if isinstance(expected, dict):
+            self.assertEqual(sorted(actual.keys()), sorted(expected.keys()))
+            for k in expected:
+                self.assertSameValue(expected[k], actual[k])
+        elif isinstance(expected, (list, tuple)):
+            self.assertEqual(len(actual), len(expected))
+            for (e, a) in zip(expected, actual):
+                self.assertSameValue(e, a)
+        else:
+            self.assertEqual(actual, expected)
+
+    def check(self, signature, args):
+        try:
+            m = dbus.lowlevel.SignalMessage('/', 'a.b', 'c')
+            m.append(signature=signature, *args)
+            expected = m.get_args_list()
+        except Exception as e:
+            self.assertRaises(e.__class__, dbusmock.mockobject._convert_args,
+                              signature, args)
+            return
+
+        self.assertSameValue(expected, dbusmock.mockobject._convert_args(signature, args))
+
+    def test_basic(self):
+        self.check('y', [b'a'])
+        self.check('y', ['a'])
+        self.check('y', [5])
+        self.check('i', ['a'])
+        self.check('s', ['a'])
+        self.check('s', [b'a'])
+        self.check('ay', [b'ab'])
+        self.check('(is)', [(1, 'a')])
+
+    def test_variant(self):
+        self.check('v', ['x'])
+        self.check('v', [b'abc'])
+        self.check('v', [1])
+        self.check('v', [1.5])
+        self.check('v', [True])
+        self.check('v', [dbus.UInt16(1)])
+        self.check('v', [(1, 'a')])
+        self.check('v', [['a', 'b']])
+        self.check('v', [{'a': 1}])
+        self.check('a{sv}', [{'a': 1, 'b': b'x', 'c': ['y']}])
+
+    def test_variant_empty(self):
+        self.check('v', [[]])
+        self.check('v', [{}])
+        self.check('v', [dbus.Array([], signature='s')])
+        self.check('v', [dbus.Dictionary({}, signature='sv')])
+        self.check('a{sv}', [{'a': []}])
+
+
 if __name__ == '__main__':
     # avoid writing to stderr
     unittest.main(testRunner=unittest.TextTestRunner(stream=sys.stdout, verbosity=2))
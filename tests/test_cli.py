@@ -14,6 +14,9 @@ __license__ = 'LGPL 3+'
 import unittest
 import sys
 import subprocess
+import tempfile
+
+import dbus
 
 import dbusmock
 
@@ -71,6 +74,155 @@ class TestCLI(dbusmock.DBusTestCase):
 
         self.p_mock.stdout.close()
 
+    def test_buffered_log(self):
+        with tempfile.NamedTemporaryFile() as log:
+            self.p_mock = subprocess.Popen([sys.executable, '-m', 'dbusmock',
+                                            '--buffered-log', '--log-flush-interval', '60',
+                                            '-l', log.name,
+                                            'com.example.Test', '/', 'org.freedesktop.Test.Main'])
+            self.wait_for_bus_object('com.example.Test', '/')
+
+            obj = self.session_con.get_object('com.example.Test', '/')
+            obj.AddMethod('', 'Do', 'i', '', '', dbus_interface=dbusmock.MOCK_IFACE)
+            for i in range(50):
+                obj.Do(i, dbus_interface='org.freedesktop.Test.Main')
+
+            # explicit flush
+            obj.FlushLog(dbus_interface=dbusmock.MOCK_IFACE)
+            with open(log.name) as f:
+                lines = f.readlines()
+            self.assertEqual(len(lines), 50)
+            self.assertRegex(lines[-1], '^[0-9.]+ Do 49$')
+
+            # flush on termination
+            obj.Do(50, dbus_interface='org.freedesktop.Test.Main')
+            self.p_mock.terminate()
+            self.p_mock.wait()
+            self.p_mock = None
+            with open(log.name) as f:
+                lines = f.readlines()
+            self.assertEqual(len(lines), 51)
+            self.assertRegex(lines[-1], '^[0-9.]+ Do 50$')
+
+    def test_state(self):
+        with tempfile.NamedTemporaryFile(suffix='.json') as state:
+            self.p_mock = subprocess.Popen([sys.executable, '-m', 'dbusmock',
+                                            '--system', '-t', 'upower'],
+                                           stdout=subprocess.PIPE)
+            self.wait_for_bus_object('org.freedesktop.UPower', '/org/freedesktop/UPower', True)
+            obj_upower = self.system_con.get_object('org.freedesktop.UPower', '/org/freedesktop/UPower')
+            mock = dbus.Interface(obj_upower, dbusmock.MOCK_IFACE)
+            mock.AddDischargingBattery('mock_BAT', 'Mock Battery', 30.0, 1200)
+            mock.SaveState(state.name)
+            self.p_mock.stdout.close()
+            self.p_mock.terminate()
+            self.p_mock.wait()
+
+            self.p_mock = subprocess.Popen([sys.executable, '-m', 'dbusmock', '--system',
+                                            '--state', state.name, 'org.freedesktop.UPower',
+                                            '/org/freedesktop/UPower', 'org.freedesktop.UPower'])
+            self.wait_for_bus_object('org.freedesktop.UPower', '/org/freedesktop/UPower', True)
+
+        obj_upower = self.system_con.get_object('org.freedesktop.UPower', '/org/freedesktop/UPower')
+        devices = obj_upower.EnumerateDevices(dbus_interface='org.freedesktop.UPower')
+        self.assertEqual(devices, ['/org/freedesktop/UPower/devices/mock_BAT'])
+        bat = self.system_con.get_object('org.freedesktop.UPower', devices[0])
+        percentage = bat.Get('org.freedesktop.UPower.Device', 'Percentage',
+                             dbus_interface=dbus.PROPERTIES_IFACE)
+        self.assertEqual(percentage, 30.0)
+        self.assertEqual(type(percentage), dbus.Double)
+        # the template's mock methods work
+        mock = dbus.Interface(obj_upower, dbusmock.MOCK_IFACE)
+        mock.AddAC('mock_AC', 'Mock AC')
+        self.assertEqual(len(obj_upower.EnumerateDevices(dbus_interface='org.freedesktop.UPower')), 2)
+
+        # Reset() goes back to the state file, also when doing it twice
+        for i in range(2):
+            mock.Reset(True)
+            self.assertEqual(obj_upower.EnumerateDevices(dbus_interface='org.freedesktop.UPower'),
+                             ['/org/freedesktop/UPower/devices/mock_BAT'])
+        mock.Reset(False)
+        self.assertRaises(dbus.exceptions.DBusException, obj_upower.EnumerateDevices,
+                          dbus_interface='org.freedesktop.UPower')
+
+    def test_state_local_template(self):
+        with tempfile.NamedTemporaryFile(prefix='answer_', suffix='.py') as my_template:
+            my_template.write(b'''import dbus
+BUS_NAME = 'com.example.Test'
+MAIN_OBJ = '/'
+MAIN_IFACE = 'org.freedesktop.Test.Main'
+SYSTEM_BUS = False
+
+def load(mock, parameters):
+    mock.AddMethods(MAIN_IFACE, [('Answer', '', 'i', Answer)])
+
+def Answer(self):
+    return 42
+''')
+            my_template.flush()
+
+            with tempfile.NamedTemporaryFile(suffix='.json') as state:
+                self.p_mock = subprocess.Popen([sys.executable, '-m', 'dbusmock',
+                                                'com.example.Test', '/', 'org.freedesktop.Test.Main'],
+                                               stdout=subprocess.PIPE)
+                self.wait_for_bus_object('com.example.Test', '/')
+                obj = self.session_con.get_object('com.example.Test', '/')
+                mock = dbus.Interface(obj, dbusmock.MOCK_IFACE)
+                mock.AddTemplate(my_template.name, dbus.Dictionary({}, signature='sv'))
+                mock.SaveState(state.name)
+                self.p_mock.stdout.close()
+                self.p_mock.terminate()
+                self.p_mock.wait()
+
+                # a new process finds the template by its path
+                self.p_mock = subprocess.Popen([sys.executable, '-m', 'dbusmock',
+                                                '--state', state.name,
+                                                'com.example.Test', '/', 'org.freedesktop.Test.Main'])
+                self.wait_for_bus_object('com.example.Test', '/')
+
+        obj = self.session_con.get_object('com.example.Test', '/')
+        self.assertEqual(obj.Answer(dbus_interface='org.freedesktop.Test.Main'), 42)
+
+    def test_state_template(self):
+        p = subprocess.Popen([sys.executable, '-m', 'dbusmock', '-t', 'upower',
+                              '--state', '/nonexisting'],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+        (out, err) = p.communicate()
+        self.assertTrue('mutually exclusive' in err, err)
+        self.assertNotEqual(p.returncode, 0)
+
+    def test_state_invalid(self):
+        with tempfile.NamedTemporaryFile(suffix='.json') as state:
+            state.write(b'{"version": 1, "objects": [{"nopath": 1}]}')
+            state.flush()
+            p = subprocess.Popen([sys.executable, '-m', 'dbusmock', '--state', state.name,
+                                  'com.example.Test', '/', 'TestIface'],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 universal_newlines=True)
+            (out, err) = p.communicate()
+        self.assertTrue('invalid state file' in err, err)
+        self.assertFalse('Traceback' in err, err)
+        self.assertNotEqual(p.returncode, 0)
+
+    def test_call_log_capacity_negative(self):
+        p = subprocess.Popen([sys.executable, '-m', 'dbusmock', '--call-log-capacity', '-1',
+                              'com.example.Test', '/', 'org.freedesktop.Test.Main'],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+        (out, err) = p.communicate()
+        self.assertTrue('--call-log-capacity must not be negative' in err, err)
+        self.assertNotEqual(p.returncode, 0)
+
+    def test_worker_threads_zero(self):
+        p = subprocess.Popen([sys.executable, '-m', 'dbusmock', '--worker-threads', '0',
+                              'com.example.Test', '/', 'org.freedesktop.Test.Main'],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+        (out, err) = p.communicate()
+        self.assertTrue('--worker-threads must be at least 1' in err, err)
+        self.assertNotEqual(p.returncode, 0)
+
     def test_no_args(self):
         p = subprocess.Popen([sys.executable, '-m', 'dbusmock'],
                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
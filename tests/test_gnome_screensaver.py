@@ -17,8 +17,14 @@ import sys
 import subprocess
 import fcntl
 
+import dbus.mainloop.glib
+
 import dbusmock
 
+from gi.repository import GLib
+
+dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+
 
 class TestGnomeScreensaver(dbusmock.DBusTestCase):
     '''Test mocking gnome-screensaver'''
@@ -54,6 +60,18 @@ class TestGnomeScreensaver(dbusmock.DBusTestCase):
         self.assertRegex(self.p_mock.stdout.read(),
                          b'emit org.gnome.ScreenSaver.ActiveChanged True\n')
 
+    def test_lock_does_not_block(self):
+        '''Lock() takes a while, but does not block other calls'''
+
+        loop = GLib.MainLoop()
+        self.obj_ss.Lock(reply_handler=loop.quit, error_handler=lambda e: loop.quit())
+        # still answers while locking
+        self.assertEqual(self.obj_ss.GetActive(), False)
+
+        GLib.timeout_add(5000, loop.quit)
+        loop.run()
+        self.assertEqual(self.obj_ss.GetActive(), True)
+
     def test_set_active(self):
         '''SetActive()'''
 
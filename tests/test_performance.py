@@ -0,0 +1,432 @@
+#!/usr/bin/python3
+
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option) any
+# later version.  See http://www.gnu.org/copyleft/lgpl.html for the full text
+# of the license.
+
+__author__ = 'Martin Pitt'
+__email__ = 'martin.pitt@ubuntu.com'
+__copyright__ = '(c) 2013 Canonical Ltd.'
+__license__ = 'LGPL 3+'
+
+import unittest
+import sys
+import os
+import time
+import timeit
+import json
+import tempfile
+
+import dbus
+import dbus.mainloop.glib
+
+import dbusmock
+
+from gi.repository import GLib
+
+dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+
+
+def report(what, count, seconds):
+    '''Print the result of a benchmark'''
+
+    sys.stdout.write('\n  %s: %i in %.3f s (%.1f us each, %.0f/s) ' % (
+        what, count, seconds, seconds * 1000000 / count, count / seconds))
+    sys.stdout.flush()
+
+
+class TestPerformance(dbusmock.DBusTestCase):
+    '''Benchmarks for the mock server
+
+    These print their timings, and only fail on gross regressions.
+    '''
+    @classmethod
+    def setUpClass(klass):
+        klass.start_session_bus()
+        klass.dbus_con = klass.get_dbus()
+
+    def setUp(self):
+        self.devnull = open(os.devnull, 'w')
+        self.p_mock = self.spawn_server('org.freedesktop.Test',
+                                        '/',
+                                        'org.freedesktop.Test.Main',
+                                        stdout=self.devnull)
+
+        self.obj_test = self.dbus_con.get_object('org.freedesktop.Test', '/')
+        self.dbus_test = dbus.Interface(self.obj_test, 'org.freedesktop.Test.Main')
+        self.dbus_mock = dbus.Interface(self.obj_test, dbusmock.MOCK_IFACE)
+
+    def tearDown(self):
+        self.p_mock.terminate()
+        self.p_mock.wait()
+        self.devnull.close()
+
+    def test_method_code_compile(self):
+        '''cost of running method code snippets'''
+
+        code = 'ret = args[0] * args[1]'
+        code_object = compile(code, '<test>', 'exec')
+        count = 20000
+
+        def run(c):
+            loc = {'args': ('foo', 3)}
+            exec(c, {}, loc)
+            return loc['ret']
+
+        # what mock_method() used to do: compile the source on every call
+        t = timeit.timeit(lambda: run(code), number=count)
+        report('exec() of source', count, t)
+        # what it does now: run the code object compiled by AddMethod()
+        t_compiled = timeit.timeit(lambda: run(code_object), number=count)
+        report('exec() of code object', count, t_compiled)
+        self.assertLess(t_compiled, t)
+
+        # end to end D-Bus calls
+        self.dbus_mock.AddMethod('', 'Do', 'si', 's', code)
+        count = 2000
+        start = time.time()
+        for i in range(count):
+            self.dbus_test.Do('foo', 3)
+        report('D-Bus calls of method with code', count, time.time() - start)
+
+    def test_many_objects_with_distinct_methods(self):
+        '''10,000 objects with distinct methods'''
+
+        count = 10000
+        self.dbus_mock.AddMethod('', 'Populate', 'u', '', '''for i in range(args[0]):
+    self.AddObject("/obj%i" % i, "org.freedesktop.Test.Sub", {},
+                   [("Method%i" % i, "", "u", "ret = %i" % i)])
+''')
+        start = time.time()
+        self.dbus_test.Populate(count, timeout=600)
+        report('objects with one distinct method created', count, time.time() - start)
+
+        # every object only has its own method
+        start = time.time()
+        for i in range(0, count, 10):
+            obj = self.dbus_con.get_object('org.freedesktop.Test', '/obj%i' % i,
+                                           introspect=False)
+            self.assertEqual(obj.get_dbus_method('Method%i' % i, 'org.freedesktop.Test.Sub')(), i)
+            other = obj.get_dbus_method('Method%i' % (i + 1), 'org.freedesktop.Test.Sub')
+            self.assertRaises(dbus.exceptions.DBusException, other)
+        report('method calls on different objects', count // 5, time.time() - start)
+
+        # main object did not get any of them
+        self.assertRaises(dbus.exceptions.DBusException,
+                          self.obj_test.get_dbus_method('Method0', 'org.freedesktop.Test.Sub'))
+
+    def test_introspect_many_methods(self):
+        '''repeated introspection of an object with 500 methods'''
+
+        methods = [('Method%i' % i, 'su', 's', 'ret = args[0]') for i in range(500)]
+        self.dbus_mock.AddMethods('', methods)
+        dbus_introspect = dbus.Interface(self.obj_test, dbus.INTROSPECTABLE_IFACE)
+
+        start = time.time()
+        xml = dbus_introspect.Introspect()
+        report('first Introspect()', 1, time.time() - start)
+        self.assertTrue('<method name="Method499">' in xml)
+
+        count = 500
+        start = time.time()
+        for i in range(count):
+            self.assertEqual(dbus_introspect.Introspect(), xml)
+        report('cached Introspect()', count, time.time() - start)
+
+        # adding a method invalidates the cache
+        self.dbus_mock.AddMethod('', 'Method500', '', '', '')
+        self.assertTrue('<method name="Method500">' in dbus_introspect.Introspect())
+
+    def test_logind_list_sessions(self):
+        '''logind ListSessions() with 5,000 sessions'''
+
+        self.dbus_mock.AddTemplate('logind', {})
+        count = 5000
+        self.dbus_mock.AddMethod('', 'Populate', 'u', '', '''for i in range(args[0]):
+    self.AddSession("c%i" % i, "seat0", 1000 + i % 100, "user%i" % (i % 100), True)
+''')
+        # compare D-Bus Get() and get_property() on all sessions in the mock
+        self.dbus_mock.AddMethod('', 'CompareGet', '', 'dd', '''import time
+sessions = [objects[k] for k in get_children("/org/freedesktop/login1/session")]
+start = time.time()
+for o in sessions:
+    o.Get("org.freedesktop.login1.Session", "Name")
+t_get = time.time() - start
+start = time.time()
+for o in sessions:
+    o.get_property("org.freedesktop.login1.Session", "Name")
+ret = (t_get, time.time() - start)
+''')
+        start = time.time()
+        self.dbus_test.Populate(count, timeout=600)
+        report('sessions added', count, time.time() - start)
+
+        (t_get, t_get_property) = self.dbus_test.CompareGet()
+        report('Get() of session property', count, t_get)
+        report('get_property() of session property', count, t_get_property)
+
+        login1 = dbus.Interface(self.obj_test, 'org.freedesktop.login1.Manager')
+        runs = 10
+        start = time.time()
+        for i in range(runs):
+            self.assertEqual(len(login1.ListSessions()), count)
+        report('ListSessions()', runs, time.time() - start)
+
+    def test_add_objects(self):
+        '''AddObject() vs. AddObjects() for 1,000 objects'''
+
+        count = 1000
+        start = time.time()
+        for i in range(count):
+            self.dbus_mock.AddObject('/single/obj%i' % i, 'org.freedesktop.Test.Sub',
+                                     {'Index': dbus.UInt32(i)}, [('Do', '', '', '')])
+        t_single = time.time() - start
+        report('AddObject() calls', count, t_single)
+
+        start = time.time()
+        errors = self.dbus_mock.AddObjects(
+            [('/batch/obj%i' % i, 'org.freedesktop.Test.Sub',
+              {'Index': dbus.UInt32(i)}, [('Do', '', '', '')]) for i in range(count)],
+            True, timeout=600)
+        t_batch = time.time() - start
+        report('objects added with AddObjects()', count, t_batch)
+        self.assertEqual(errors, [''] * count)
+        self.assertLess(t_batch, t_single)
+
+    def test_update_properties(self):
+        '''Set() vs. UpdateProperties() for 500 objects'''
+
+        count = 500
+        iface = 'org.freedesktop.UPower.Device'
+        self.dbus_mock.AddObjects(
+            [('/bat%i' % i, iface, {'Percentage': dbus.Double(100.0)}, []) for i in range(count)],
+            False)
+        props = [dbus.Interface(self.dbus_con.get_object('org.freedesktop.Test', '/bat%i' % i,
+                                                         introspect=False),
+                                dbus.PROPERTIES_IFACE)
+                 for i in range(count)]
+
+        start = time.time()
+        for p in props:
+            p.Set(iface, 'Percentage', dbus.Double(50.0, variant_level=1))
+        t_set = time.time() - start
+        report('Set() calls', count, t_set)
+
+        start = time.time()
+        self.dbus_mock.UpdateProperties(
+            dict(('/bat%i' % i, {iface: {'Percentage': dbus.Double(25.0)}}) for i in range(count)))
+        t_update = time.time() - start
+        report('properties changed with UpdateProperties()', count, t_update)
+        self.assertLess(t_update, t_set)
+        self.assertEqual(props[-1].Get(iface, 'Percentage'), 25.0)
+
+    def test_emit_signal(self):
+        '''EmitSignal() throughput'''
+
+        args = ['hello', dbus.UInt32(42), ['/a', '/b']]
+        self.dbus_mock.AddMethod('', 'Emit', 'u', 'd', '''start = time.time()
+for i in range(args[0]):
+    self.EmitSignal("", "Sig", "suao", ["hello", dbus.UInt32(42), ["/a", "/b"]])
+ret = time.time() - start''')
+
+        count = 20000
+        t = self.dbus_test.Emit(count, timeout=600)
+        report('signals emitted inside the mock', count, t)
+
+        count = 2000
+        start = time.time()
+        for i in range(count):
+            self.dbus_mock.EmitSignal('', 'Sig', 'suao', args)
+        report('EmitSignal() calls', count, time.time() - start)
+
+    def test_signal_stream(self):
+        '''signal stream at 5,000 Hz for 2 seconds'''
+
+        self.dbus_mock.SetLogLevel('off')
+        stream = self.dbus_mock.StartSignalStream('', 'Tick', 'ud', [[dbus.UInt32(1), 0.5]],
+                                                  5000.0, 0, 2.0)
+        # the mock keeps answering calls
+        calls = 0
+        start = time.time()
+        while time.time() - start < 2.5:
+            self.dbus_mock.GetSignalStreamInfo(stream)
+            calls += 1
+        report('method calls during signal stream', calls, time.time() - start)
+
+        info = self.dbus_mock.StopSignalStream(stream)
+        report('streamed signals', info['emitted'], info['elapsed'])
+        sys.stdout.write('(max lag %.3f s) ' % info['max_lag'])
+        self.assertEqual(info['emitted'], 10000)
+
+    def test_threaded_methods(self):
+        '''cheap calls while slow methods run, with and without threads'''
+
+        self.dbus_mock.SetLogLevel('off')
+        # threads only help for code which releases the GIL, like waiting for
+        # I/O or sleeping; the slow calls wait until the gate opens, or until
+        # the timeout
+        self.dbus_mock.AddMethod('', 'CloseGate', 'd', '', '''self.gate = threading.Event()
+self.gate_timeout = args[0]''')
+        self.dbus_mock.AddMethod('', 'OpenGate', '', '', 'self.gate.set()')
+        self.dbus_mock.AddMethod('', 'Slow', '', 'u', '''self.gate.wait(self.gate_timeout)
+ret = 1''')
+        self.dbus_mock.AddMethod('', 'Cheap', '', 'u', 'ret = 1')
+        loop = GLib.MainLoop()
+        n_slow = 8
+        n_cheap = 100
+
+        def measure(what, threaded):
+            pending = [n_slow]
+
+            def done(*args):
+                pending[0] -= 1
+                if pending[0] == 0:
+                    loop.quit()
+
+            # without threads, each slow call takes 0.2 s; with threads, they
+            # only finish when the gate opens after the cheap calls
+            self.dbus_test.CloseGate(60.0 if threaded else 0.2)
+            start = time.time()
+            for i in range(n_slow):
+                self.dbus_test.Slow(reply_handler=done, error_handler=done, timeout=600)
+            for i in range(n_cheap):
+                self.dbus_test.Cheap()
+            t_cheap = time.time() - start
+            report('cheap calls with %s' % what, n_cheap, t_cheap)
+
+            if threaded:
+                # all threads run a slow call at the same time
+                info = self.dbus_mock.GetWorkerPoolInfo()
+                timeout = 100
+                while info['running'] < min(n_slow, info['threads']) and timeout > 0:
+                    time.sleep(0.1)
+                    timeout -= 1
+                    info = self.dbus_mock.GetWorkerPoolInfo()
+                self.assertEqual(info['running'], min(n_slow, info['threads']))
+                self.dbus_test.OpenGate()
+
+            GLib.timeout_add(60000, loop.quit)
+            loop.run()
+            self.assertEqual(pending[0], 0)
+            t_slow = time.time() - start
+            report('slow calls with %s' % what, n_slow, t_slow)
+            return t_cheap
+
+        t_cheap_blocking = measure('blocking methods', False)
+        # without threads, the cheap calls wait for all slow ones
+        self.assertGreaterEqual(t_cheap_blocking, n_slow * 0.2)
+
+        # with threads, the cheap calls get answered while the slow calls
+        # still wait for the gate, i. e. before the first slow reply
+        self.dbus_mock.SetMethodThreaded('', 'Slow', True)
+        measure('threaded methods', True)
+        info = self.dbus_mock.GetWorkerPoolInfo()
+        sys.stdout.write('(max queue depth %i) ' % info['max_queued'])
+        self.assertEqual(info['completed'], n_slow)
+
+    def test_reset(self):
+        '''Reset() vs. starting a new mock with a template'''
+
+        # use the session bus; the upower template does not care where it runs
+        count = 5
+        start = time.time()
+        for i in range(count):
+            p_mock = self.spawn_server('org.freedesktop.Test2', '/', 'org.freedesktop.Test.Main',
+                                       stdout=self.devnull)
+            obj = self.dbus_con.get_object('org.freedesktop.Test2', '/')
+            obj.AddTemplate('upower', dbus.Dictionary({}, signature='sv'),
+                            dbus_interface=dbusmock.MOCK_IFACE)
+            p_mock.terminate()
+            p_mock.wait()
+        t_spawn = time.time() - start
+        report('mock processes started with a template', count, t_spawn)
+
+        self.dbus_mock.AddTemplate('upower', dbus.Dictionary({}, signature='sv'))
+        count = 100
+        start = time.time()
+        for i in range(count):
+            self.dbus_mock.AddObject('/extra', 'org.freedesktop.Test.Sub', {}, [])
+            self.reset_server(self.obj_test)
+        t_reset = time.time() - start
+        report('resets with the template', count, t_reset)
+        self.assertLess(t_reset / 100, t_spawn / 5)
+
+    def test_snapshots(self):
+        '''RestoreSnapshot() vs. rebuilding 2,000 objects'''
+
+        count = 2000
+        new_objects = [('/dev%i' % i, 'org.freedesktop.Test.Sub',
+                        {'Index': dbus.UInt32(i), 'Name': 'device %i' % i},
+                        [('Do', 'u', 'u', 'ret = args[0] + %i' % i)]) for i in range(count)]
+        start = time.time()
+        self.dbus_mock.AddObjects(new_objects, False, timeout=600)
+        t_build = time.time() - start
+        report('objects built with AddObjects()', count, t_build)
+
+        start = time.time()
+        self.dbus_mock.SaveSnapshot('base', timeout=600)
+        report('objects saved in snapshot', count, time.time() - start)
+
+        # a variant: change some objects, remove some, add some
+        self.dbus_mock.UpdateProperties(dict(
+            ('/dev%i' % i, {'org.freedesktop.Test.Sub': {'Index': dbus.UInt32(0)}})
+            for i in range(0, count, 2)))
+        for i in range(0, count, 100):
+            self.dbus_mock.RemoveObject('/dev%i' % i)
+            self.dbus_mock.AddObject('/extra%i' % i, 'org.freedesktop.Test.Sub', {}, [])
+
+        start = time.time()
+        self.dbus_mock.RestoreSnapshot('base', timeout=600)
+        t_restore = time.time() - start
+        report('objects restored from snapshot', count, t_restore)
+        self.assertLess(t_restore, t_build)
+
+        obj = self.dbus_con.get_object('org.freedesktop.Test', '/dev100', introspect=False)
+        self.assertEqual(obj.Do(1, dbus_interface='org.freedesktop.Test.Sub'), 101)
+
+    def load_state_file(self, count):
+        '''Benchmark LoadState() and SaveState() with count objects'''
+
+        self.dbus_mock.SetLogLevel('off')
+        state = {'version': 1, 'objects': [
+            {'path': '/dev%i' % i,
+             'interface': 'org.freedesktop.Test.Sub',
+             'properties': {'org.freedesktop.Test.Sub': {'Index': ['u', i],
+                                                         'Name': ['s', 'device %i' % i]}},
+             'methods': {'org.freedesktop.Test.Sub': {'Do': ['u', 'u', 'ret = args[0] * 2']}}}
+            for i in range(count)]}
+
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.json') as f:
+            json.dump(state, f, separators=(',', ':'))
+            f.flush()
+            start = time.time()
+            self.dbus_mock.LoadState(f.name, timeout=3600)
+            report('objects loaded from state file', count, time.time() - start)
+
+        obj = self.dbus_con.get_object('org.freedesktop.Test', '/dev%i' % (count - 1), introspect=False)
+        self.assertEqual(obj.Do(2, dbus_interface='org.freedesktop.Test.Sub'), 4)
+
+        with tempfile.NamedTemporaryFile(suffix='.json') as f:
+            start = time.time()
+            self.dbus_mock.SaveState(f.name, timeout=3600)
+            report('objects saved into state file', count, time.time() - start)
+            sys.stdout.write('(%i bytes) ' % os.path.getsize(f.name))
+
+    def test_state_file(self):
+        '''LoadState() and SaveState() with 10,000 objects'''
+
+        self.load_state_file(10000)
+
+    @unittest.skipUnless(os.environ.get('DBUSMOCK_LARGE_BENCHMARKS'),
+                         'set $DBUSMOCK_LARGE_BENCHMARKS to run')
+    def test_state_file_large(self):
+        '''LoadState() and SaveState() with 100,000 objects'''
+
+        self.load_state_file(100000)
+
+
+if __name__ == '__main__':
+    # avoid writing to stderr
+    unittest.main(testRunner=unittest.TextTestRunner(stream=sys.stdout, verbosity=2))
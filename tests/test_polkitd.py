@@ -33,15 +33,19 @@ class TestPolkit(dbusmock.DBusTestCase):
     def setUpClass(klass):
         klass.start_system_bus()
         klass.dbus_con = klass.get_dbus(True)
-
-    def setUp(self):
-        (self.p_mock, self.obj_polkitd) = self.spawn_server_template(
+        # one mock for all tests, reset after each
+        (klass.p_mock, klass.obj_polkitd) = klass.spawn_server_template(
             'polkitd', {}, stdout=subprocess.PIPE)
-        self.dbusmock = dbus.Interface(self.obj_polkitd, dbusmock.MOCK_IFACE)
+        klass.dbusmock = dbus.Interface(klass.obj_polkitd, dbusmock.MOCK_IFACE)
+
+    @classmethod
+    def tearDownClass(klass):
+        klass.p_mock.terminate()
+        klass.p_mock.wait()
+        super(TestPolkit, klass).tearDownClass()
 
     def tearDown(self):
-        self.p_mock.terminate()
-        self.p_mock.wait()
+        self.reset_server(self.obj_polkitd)
 
     def test_default(self):
         self.check_action('org.freedesktop.test.frobnicate', False)